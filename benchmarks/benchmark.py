@@ -0,0 +1,221 @@
+"""This module benchmarks the pose estimation pipelines on synthetic RGB-D scenes.
+
+Run from the repository root, pipeline parameters are passed as for main.py:
+
+    python -m benchmarks.benchmark --samples 100 --modes cv sam --output bench.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import warnings
+
+import numpy as np
+import cv2
+
+from main import get_args_parser, validate_args
+from pose_estimation.pose_estimation_cv import pose_estimation_cv
+from pose_estimation.pose_estimation_sam import pose_estimation_sam
+from pose_estimation.pose_estimation_plane import pose_estimation_plane
+from pose_estimation.tracking import PoseTracker
+from pose_estimation.segmentation.sam_registry import SAM_REGISTRY, sam_backend
+from pose_estimation.segmentation.sam_onnx import mask_iou
+from pose_estimation.segmentation.segment import sam_predict_batch
+from pose_estimation.segmentation.backends import SEGMENTERS
+from pose_estimation.utils.utils import load_image, roi
+from pose_estimation.utils.profiling import Profiler
+from pose_estimation.config import freeze
+from benchmarks.synthetic import render_scene, sample_poses, sample_trajectory
+
+PIPELINES = {"cv": pose_estimation_cv, "sam": pose_estimation_sam, "plane": pose_estimation_plane}
+MODES = [*PIPELINES, "track"]
+POSE_KEYS = ["x", "y", "z", "roll", "pitch", "yaw"]
+
+
+def get_bench_parser():
+    parser = argparse.ArgumentParser('Pose estimation benchmark', parents=[get_args_parser()])
+
+    parser.add_argument('--samples', default=50, type=int, help="Number of synthetic scenes")
+    parser.add_argument('--seed', default=0, type=int, help="Random seed of the scene generator")
+    parser.add_argument('--modes', default=["cv"], nargs='+', choices=MODES, help="Pipelines to benchmark, track runs the CV pipeline with frame-to-frame tracking")
+    parser.add_argument('--warmup', default=3, type=int, help="Number of untimed warmup runs per mode")
+    parser.add_argument('--sequence', action='store_true', help="Render the scenes as a continuous sequence of a moving brick")
+    parser.add_argument('--encoded', action='store_true', help="Pass PNG encoded images to include decoding in the timings")
+    parser.add_argument('--distance', default=[500.0, 700.0], nargs=2, type=float, help="Range of brick distances (mm)")
+    parser.add_argument('--max-angle', default=[8.0, 3.0, 12.0], nargs=3, type=float, help="Maximum absolute roll, pitch, yaw (deg)")
+    parser.add_argument('--offset', default=[10, 5], nargs=2, type=float, help="Maximum offset (x, y) of the brick from the ROI center (px)")
+    parser.add_argument('--corner-ratio', default=0.2, type=float, help="Ratio of corner stones")
+    parser.add_argument('--noise', default=3.0, type=float, help="Standard deviation of color noise")
+    parser.add_argument('--depth-noise', default=0.0, type=float, help="Standard deviation of depth noise (mm)")
+    parser.add_argument('--dropout', default=0.0, type=float, help="Ratio of invalid depth pixels")
+    parser.add_argument('--check-masks', action='store_true', help="Compare the SAM masks of --sam-backend with the PyTorch backend")
+    parser.add_argument('--check-segmenters', default=None, nargs='+', choices=list(SEGMENTERS), help="Measure mask IoU with the ground truth and time per ROI of mask backends")
+    parser.add_argument('--write-mask-costs', default=None, type=str, help="Write the measured cost_ms and accuracy of --check-segmenters as --mask-costs file")
+    parser.add_argument('--output', default=None, type=str, help="Write the results as JSON")
+
+    return parser
+
+
+def make_scenes(args):
+    """Render all benchmark scenes before timing."""
+
+    scenes = []
+    if args.sequence:
+        poses = sample_trajectory(args.samples, args, args.seed, distance=args.distance, max_angle=args.max_angle)
+    else:
+        poses = sample_poses(args.samples, args, args.seed, distance=args.distance,
+                             max_angle=args.max_angle, corner_ratio=args.corner_ratio, offset=args.offset)
+    for i, (pose, corner_stone) in enumerate(poses):
+        color, depth, truth = render_scene(pose, args, corner_stone, noise=args.noise, depth_noise=args.depth_noise,
+                                           dropout=args.dropout, seed=args.seed + i, face_mask=bool(args.check_segmenters))
+        if args.encoded:
+            color, depth = cv2.imencode('.png', color)[1].tobytes(), cv2.imencode('.png', depth)[1].tobytes()
+        scenes.append((color, depth, truth))
+
+    return scenes
+
+
+def run_mode(mode, scenes, args):
+    """Time the end-to-end estimation and its stages on all scenes and compare
+    the estimated poses with the ground truth."""
+
+    estimate = PIPELINES.get(mode, pose_estimation_cv)
+
+    for color, depth, _ in scenes[:args.warmup]:
+        try:
+            estimate(color, depth, args)
+        except AssertionError:
+            pass
+
+    # The tracker is stateful, failed frames reset it to full detection
+    if mode == "track":
+        tracker = PoseTracker(args)
+
+        def estimate(color, depth, args, profiler):
+            try:
+                return tracker.update(color, depth, profiler)
+            except AssertionError:
+                tracker.reset()
+                raise
+
+    latencies, stages, errors, failures = [], {}, [], {}
+    start = time.perf_counter()
+    for color, depth, truth in scenes:
+        profiler = Profiler()
+        t = time.perf_counter()
+        try:
+            pose = estimate(color, depth, args, profiler)["pose"]
+            errors.append([float(pose[k]) - truth[k] for k in POSE_KEYS])
+        except AssertionError as e:
+            failures[str(e)] = failures.get(str(e), 0) + 1
+        latencies.append((time.perf_counter() - t) * 1e3)
+        for name, stage in profiler.report()["stages"].items():
+            stages.setdefault(name, []).append(stage["time_ms"])
+    wall = time.perf_counter() - start
+
+    errors = np.abs(np.array(errors)).reshape(-1, len(POSE_KEYS))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mae, medae = np.nanmean(errors, axis=0), np.nanmedian(errors, axis=0)
+
+    return {
+        "samples": len(scenes),
+        "success_rate": round(len(errors) / len(scenes), 3),
+        "failures": failures,
+        "throughput_per_s": round(len(scenes) / wall, 2),
+        "latency_ms": {
+            "mean": round(float(np.mean(latencies)), 3),
+            **{f"p{q}": round(float(np.percentile(latencies, q)), 3) for q in (50, 90, 99)},
+        },
+        "stages_ms": {name: round(float(np.mean(times)), 3) for name, times in stages.items()},
+        "pose_mae": {k: round(float(v), 2) for k, v in zip(POSE_KEYS, mae)},
+        "pose_median_ae": {k: round(float(v), 2) for k, v in zip(POSE_KEYS, medae)},
+    }
+
+
+def check_masks(scenes, args):
+    """Compare the SAM masks of the selected backend with the PyTorch backend on
+    the ROIs of all scenes: intersection over union of the highest scoring masks,
+    of all three multimask outputs and agreement of the highest scoring mask."""
+
+    rois = [roi(load_image(color), args) for color, _, _ in scenes]
+    reference = sam_predict_batch(rois, freeze(args, sam_backend="torch", sam_quantize=False))
+    predictions = sam_predict_batch(rois, args)
+
+    best_ious, ious, agreement = [], [], []
+    for (ref_masks, ref_scores), (masks, scores) in zip(reference, predictions):
+        best_ious.append(mask_iou(ref_masks[np.argmax(ref_scores)], masks[np.argmax(scores)]))
+        ious.extend(mask_iou(a, b) for a, b in zip(ref_masks, masks))
+        agreement.append(np.argmax(ref_scores) == np.argmax(scores))
+
+    return {
+        "best_mask_iou": {"mean": round(float(np.mean(best_ious)), 4), "min": round(float(np.min(best_ious)), 4)},
+        "mask_iou": {"mean": round(float(np.mean(ious)), 4), "min": round(float(np.min(ious)), 4)},
+        "best_mask_agreement": round(float(np.mean(agreement)), 3),
+    }
+
+
+def check_segmenters(scenes, args):
+    """Mean and minimum IoU of the masks of each mask backend with the ground
+    truth brick face in the ROI and the mean time per ROI, the values declared
+    as accuracy and cost_ms in SEGMENTERS."""
+
+    rois = [roi(load_image(color), args) for color, _, _ in scenes]
+    truths = [roi(truth["face_mask"], args) for _, _, truth in scenes]
+    report = {}
+    for name in args.check_segmenters:
+        segment = SEGMENTERS[name].segment
+        start = time.perf_counter()
+        masks = [segment([img], args)[0] for img in rois]
+        wall = time.perf_counter() - start
+        ious = [mask_iou(mask > 0, truth) for mask, truth in zip(masks, truths)]
+        report[name] = {"iou_mean": round(float(np.mean(ious)), 4), "iou_min": round(float(np.min(ious)), 4),
+                        "ms_per_roi": round(wall / len(rois) * 1e3, 2)}
+
+    return report
+
+
+def print_results(results):
+    for mode, res in results.items():
+        print(f"== {mode}: {res['samples']} samples, success rate {res['success_rate']:.1%}, "
+              f"{res['throughput_per_s']} images/s")
+        print("latency ms   " + "  ".join(f"{k} {v}" for k, v in res["latency_ms"].items()))
+        print("stages ms    " + "  ".join(f"{k} {v}" for k, v in res["stages_ms"].items()))
+        print("pose MAE     " + "  ".join(f"{k} {v}" for k, v in res["pose_mae"].items()))
+        print("pose MedAE   " + "  ".join(f"{k} {v}" for k, v in res["pose_median_ae"].items()))
+        for error, n in res["failures"].items():
+            print(f"failed {n}x: {error}")
+
+
+def main(argv=None):
+    parser = get_bench_parser()
+    args = validate_args(parser, parser.parse_args(argv))
+    SAM_REGISTRY.configure(ckpt_dir=args.sam_ckpt_dir, onnx_dir=args.sam_onnx_dir,
+                           threads=args.sam_threads, inter_threads=args.sam_inter_threads)
+
+    scenes = make_scenes(args)
+    results = {mode: run_mode(mode, scenes, args) for mode in args.modes}
+
+    print_results(results)
+    report = {"argv": sys.argv[1:], "results": results}
+    if args.check_masks:
+        report["sam_masks"] = check_masks(scenes, args)
+        print(f"== sam masks {sam_backend(args)} vs torch: " + "  ".join(f"{k} {v}" for k, v in report["sam_masks"].items()))
+    if args.check_segmenters:
+        report["segmenters"] = check_segmenters(scenes, args)
+        for name, res in report["segmenters"].items():
+            print(f"== mask backend {name}: " + "  ".join(f"{k} {v}" for k, v in res.items()))
+        if args.write_mask_costs:
+            with open(args.write_mask_costs, "w") as f:
+                json.dump({name: {"cost_ms": res["ms_per_roi"], "accuracy": res["iou_mean"]}
+                           for name, res in report["segmenters"].items()}, f, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
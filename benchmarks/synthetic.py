@@ -0,0 +1,146 @@
+"""This module renders synthetic RGB-D scenes of a brick in front of a wall at known poses."""
+
+import os
+import json
+
+import numpy as np
+import cv2
+
+MORTAR_COLOR = (170, 175, 180)
+SLOT_COLOR = (40, 40, 45)
+WALL_COLOR = (60, 75, 150)
+BRICK_COLOR = (95, 125, 205)
+
+
+def rotation(roll, pitch, yaw):
+    """Rotation of the brick front face in camera coordinates (x right, y depth, z down).
+    Roll tilts the face around the x-axis (dy/dz), pitch rotates it in the image
+    plane (dz/dx) and yaw turns it around the vertical axis (dy/dx)."""
+
+    r, p, y = np.deg2rad([roll, pitch, yaw])
+    rot_roll = np.array([[1, 0, 0], [0, np.cos(r), np.sin(r)], [0, -np.sin(r), np.cos(r)]])
+    rot_pitch = np.array([[np.cos(p), 0, -np.sin(p)], [0, 1, 0], [np.sin(p), 0, np.cos(p)]])
+    rot_yaw = np.array([[np.cos(y), -np.sin(y), 0], [np.sin(y), np.cos(y), 0], [0, 0, 1]])
+
+    return rot_yaw @ rot_roll @ rot_pitch
+
+
+def render_scene(pose, args, corner_stone=False, img_size=(480, 848), wall_offset=0.0, joint=10.0,
+                 noise=3.0, depth_noise=0.0, dropout=0.0, seed=0, face_mask=False):
+    """Render the color and depth image of a brick with front face center (x, y, z)
+    in mm and roll, pitch, yaw in degrees placed in its slot of a wall of bricks.
+    The wall plane lies wall_offset mm behind the brick front face.
+
+    The brick is rendered with the camera intrinsics and brick dimensions of args.
+    Depth is returned in the unit of the pipeline (0.1 mm), invalid pixels are 0.
+    Returns color, depth and the ground truth pose in the output convention of
+    the pipelines (y at the brick center, roll/pitch swapped for corner stones).
+    With face_mask the ground truth also holds the boolean mask of the brick front face."""
+
+    rng = np.random.default_rng(seed)
+    h, w = img_size
+    u, v = np.meshgrid(np.arange(w), np.arange(h))
+    rays = np.stack([(u - args.px) / args.fx, np.ones((h, w)), (v - args.py) / args.fy], axis=-1)
+
+    # Wall of bricks in running bond behind the brick of interest
+    wall_y = pose["y"] + wall_offset
+    wall_x, wall_z = rays[..., 0] * wall_y, rays[..., 2] * wall_y
+    row = np.floor((wall_z - pose["z"] + args.brick_height / 2 + joint / 2) / (args.brick_height + joint))
+    shift = np.where(row % 2 == 0, 0.0, (args.brick_width + joint) / 2)
+    col = np.floor((wall_x + shift - pose["x"] + args.brick_width / 2 + joint / 2) / (args.brick_width + joint))
+    local_x = wall_x + shift - pose["x"] + args.brick_width / 2 + joint / 2 - col * (args.brick_width + joint)
+    local_z = wall_z - pose["z"] + args.brick_height / 2 + joint / 2 - row * (args.brick_height + joint)
+    mortar = (local_x < joint / 2) | (local_x > args.brick_width + joint / 2) | \
+             (local_z < joint / 2) | (local_z > args.brick_height + joint / 2)
+
+    tint = ((row * 7 + col * 13) % 5)[..., None] * 6
+    color = np.where(mortar[..., None], np.array(MORTAR_COLOR, np.float32), np.array(WALL_COLOR, np.float32) + tint)
+    depth = np.where(mortar, wall_y + joint, wall_y)
+
+    # Recessed slot of the brick of interest
+    slot = (row == 0) & (col == 0)
+    color[slot] = SLOT_COLOR
+    depth = np.where(slot, wall_y + args.brick_depth, depth)
+
+    # Front face of the brick of interest, ray-plane intersection
+    width = args.brick_depth if corner_stone else args.brick_width
+    rot = rotation(pose["roll"], pose["pitch"], pose["yaw"])
+    center = np.array([pose["x"], pose["y"], pose["z"]])
+    normal = rot @ np.array([0.0, -1.0, 0.0])
+    t = (center @ normal) / (rays @ normal)
+    local = (rays * t[..., None] - center) @ rot
+    face = (np.abs(local[..., 0]) <= width / 2) & (np.abs(local[..., 2]) <= args.brick_height / 2) & (t > 0) & (t < depth)
+
+    color[face] = BRICK_COLOR
+    depth = np.where(face, t, depth)
+
+    # Sensor noise and invalid depth pixels
+    color = np.clip(color + rng.normal(0, noise, color.shape), 0, 255).astype(np.uint8)
+    depth = depth + rng.normal(0, depth_noise, depth.shape) if depth_noise else depth
+    depth = np.clip(depth * 10, 0, 65535).astype(np.uint16)
+    if dropout:
+        depth[rng.random(depth.shape) < dropout] = 0
+
+    truth = {
+        "x": pose["x"],
+        "y": pose["y"] + (args.brick_width if corner_stone else args.brick_depth) / 2,
+        "z": pose["z"],
+        "roll": pose["pitch"] if corner_stone else pose["roll"],
+        "pitch": pose["roll"] if corner_stone else pose["pitch"],
+        "yaw": pose["yaw"],
+    }
+    if face_mask:
+        truth["face_mask"] = face
+
+    return color, depth, truth
+
+
+def sample_poses(n, args, seed=0, distance=(500.0, 700.0), max_angle=(8.0, 3.0, 12.0), corner_ratio=0.0, offset=(10, 5)):
+    """Sample n random brick poses within +-offset (x, y) pixels around the ROI center
+    at the given distance range (mm), with roll, pitch, yaw uniformly within
+    +-max_angle (deg). A ratio of corner_ratio of the poses are corner stones.
+    Yields (pose, corner_stone)."""
+
+    rng = np.random.default_rng(seed)
+    for _ in range(n):
+        y = rng.uniform(*distance)
+        u = args.roi_center[0] + rng.uniform(-offset[0], offset[0])
+        v = args.roi_center[1] + rng.uniform(-offset[1], offset[1])
+        pose = {
+            "x": (u - args.px) * y / args.fx,
+            "y": y,
+            "z": (v - args.py) * y / args.fy,
+            "roll": rng.uniform(-max_angle[0], max_angle[0]),
+            "pitch": rng.uniform(-max_angle[1], max_angle[1]),
+            "yaw": rng.uniform(-max_angle[2], max_angle[2]),
+        }
+        yield pose, bool(rng.random() < corner_ratio)
+
+
+def sample_trajectory(n, args, seed=0, distance=(500.0, 700.0), max_angle=(8.0, 3.0, 12.0), step=(2.0, 0.3, 1.0)):
+    """Sample a sequence of n brick poses, e.g. of a brick being placed, as a random
+    walk starting from a pose of sample_poses. Position changes by up to step[0] mm,
+    roll and yaw by up to step[2] and pitch by up to step[1] degrees per frame.
+    Angles stay within +-max_angle (deg). Yields (pose, corner_stone)."""
+
+    rng = np.random.default_rng(seed)
+    pose, corner_stone = next(sample_poses(1, args, seed, distance, max_angle))
+    for _ in range(n):
+        yield dict(pose), corner_stone
+        for k in ("x", "y", "z"):
+            pose[k] += rng.uniform(-step[0], step[0])
+        for k, limit, s in zip(("roll", "pitch", "yaw"), max_angle, (step[2], step[1], step[2])):
+            pose[k] = float(np.clip(pose[k] + rng.uniform(-s, s), -limit, limit))
+
+
+def write_dataset(directory, n, args, seed=0, **kwargs):
+    """Write n synthetic scenes as <i>_color.png/<i>_depth.png and their
+    ground truth poses to truth.jsonl, usable by the batch mode."""
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "truth.jsonl"), "w") as f:
+        for i, (pose, corner_stone) in enumerate(sample_poses(n, args, seed)):
+            color, depth, truth = render_scene(pose, args, corner_stone, seed=seed + i, **kwargs)
+            cv2.imwrite(os.path.join(directory, f"{i:04d}_color.png"), color)
+            cv2.imwrite(os.path.join(directory, f"{i:04d}_depth.png"), depth)
+            f.write(json.dumps({"color": f"{i:04d}_color.png", "depth": f"{i:04d}_depth.png", "truth": truth}) + "\n")
@@ -1,20 +1,57 @@
 """This module runs the main script"""
 
-import os
+import time
+STARTED = time.perf_counter()  # Before the imports, reported by --startup-report
+
 import sys
+import json
 import traceback
 import argparse
-from flask import Flask, request, jsonify, render_template
+import tracemalloc
+from functools import wraps
+from contextlib import nullcontext
+from flask import Flask, Response, request, jsonify, render_template
 
 from pose_estimation.pose_estimation_cv import pose_estimation_cv
 from pose_estimation.pose_estimation_sam import pose_estimation_sam
+from pose_estimation.pose_estimation_plane import pose_estimation_plane
+from pose_estimation.segmentation.sam_registry import SAM_REGISTRY, sam_backend
+from pose_estimation.segmentation.embedding_cache import EMBEDDING_CACHE
+from pose_estimation.segmentation.backends import SEGMENTERS, select_segmenter, measured_costs, segmenter_costs
+from pose_estimation.batch import find_pairs, run_batch
+from pose_estimation.tracking import frame_source, track
+from pose_estimation.utils.profiling import Profiler, NULL_PROFILER, METRICS, startup_report
+from pose_estimation.config import freeze
+from pose_estimation.validation import PoseValidationError
+from pose_estimation.jobs import JobQueue, QueueFull
+from pose_estimation.utils.utils import IMAGE_FORMATS, encode_image, roi_slices
+from pose_estimation.utils.image_cache import IMAGE_CACHE
+from pose_estimation.calibration import load_profiles, undistort_maps
+from pose_estimation.features.points import ray_grid
 
 
-def get_args_parser():
-    parser = argparse.ArgumentParser('Place quality system', add_help=False)
+PIPELINES = {"cv": pose_estimation_cv, "sam": pose_estimation_sam, "plane": pose_estimation_plane}
+RESPONSE_FORMATS = [*IMAGE_FORMATS, "none", "lazy"]
+PROFILES = {}
+# Pre-forked worker processes, the job queue and the lazy result images are process-local
+PREFORKED = False
+
 
-    # Temporary image directory
-    parser.add_argument('--savedir', default="temp", type=str, help="Temporary save directory for uploaded images")
+def blur_kernel(value):
+    """Parse a blur kernel "kx,ky,sigma" of the canny voting to ((kx, ky), sigma)."""
+    kx, ky, sigma = value.split(",")
+    return (int(kx), int(ky)), float(sigma)
+
+def int_pair(value):
+    """Parse a pair "a,b" of integers to (a, b)."""
+    a, b = value.split(",")
+    return int(a), int(b)
+
+
+def get_args_parser(defaults=True):
+    """Pose estimation parameters. Without defaults unset options are left out of the
+    namespace, so the options of a subcommand only override the ones given before it."""
+    parser = argparse.ArgumentParser('Place quality system', add_help=False)
 
     # Brick parameters
     parser.add_argument('--brick-width', default=210.0, type=float, help="Physical width of brick")
@@ -23,14 +60,33 @@ def get_args_parser():
 
     # SAM parameters
     parser.add_argument('--sam-model', default="vit_b", type=str, help="Backbone model Meta's of Segment Anything Model (SAM)")
+    parser.add_argument('--sam-ckpt-dir', default="model_ckpts", type=str, help="Directory containing the SAM checkpoints sam_<backbone>.pth")
+    parser.add_argument('--sam-preload', default=[], nargs='*', type=str, help="SAM backbones loaded and warmed up at server start")
+    parser.add_argument('--sam-batch-size', default=1, type=int, help="Maximum number of ROIs per SAM image encoder forward pass, each ROI adds about 2 GB peak memory (vit_b, CPU)")
+    parser.add_argument('--sam-embedding-cache', default=16, type=int, help="Number of cached SAM image embeddings, 0 to disable")
+    parser.add_argument('--sam-memory-budget', default=0.0, type=float, help="Memory budget (MB) of resident SAM backbones, 0 for unlimited")
+    parser.add_argument('--mask-backend', default="sam", choices=[*SEGMENTERS, "auto"], help="Brick mask segmentation of the SAM pipeline, auto selects the cheapest backend meeting --mask-accuracy")
+    parser.add_argument('--mask-accuracy', default=0.95, type=float, help="Minimum declared mask IoU of the backend selected by --mask-backend auto")
+    parser.add_argument('--mask-costs', default=None, type=str, help="JSON file of measured cost_ms and accuracy per mask backend overriding the declared values (benchmark --write-mask-costs)")
+    parser.add_argument('--flood-tolerance', default=12.0, type=float, help="Maximum color difference to the center patch of the floodfill mask backend")
+    parser.add_argument('--sam-backend', default="torch", choices=["torch", "onnx"], help="Inference backend of SAM, onnx runs exported models on ONNX Runtime")
+    parser.add_argument('--sam-quantize', action='store_true', help="Run the ONNX backend with dynamically quantized int8 weights")
+    parser.add_argument('--sam-onnx-dir', default=None, type=str, help="Directory of the exported ONNX models, <sam-ckpt-dir>/onnx by default")
+    parser.add_argument('--sam-threads', default=0, type=int, help="Intra-op threads of the ONNX backend, 0 for the ONNX Runtime default")
+    parser.add_argument('--sam-inter-threads', default=0, type=int, help="Inter-op threads of the ONNX backend, 0 for the ONNX Runtime default")
 
     # ROI parameters
-    parser.add_argument('--roi-center', default=(424,300), type=tuple, help="ROI center image coordinates (x, y)")
-    parser.add_argument('--roi-winsize', default=(400, 100), type=tuple, help="Windows size of image ROI (width, height)")
+    parser.add_argument('--roi-center', default=(424,300), nargs=2, type=int, help="ROI center image coordinates (x, y)")
+    parser.add_argument('--roi-winsize', default=(400, 100), nargs=2, type=int, help="Windows size of image ROI (width, height)")
+    parser.add_argument('--adaptive-roi', action='store_true', help="Localize the brick coarsely and propose a tight ROI before segmentation")
+    parser.add_argument('--roi-search', default=2.0, type=float, help="Size of the localization search window relative to the ROI")
+    parser.add_argument('--roi-pyramid', default=1, type=int, help="Number of pyramid downsampling steps of the localization")
+    parser.add_argument('--roi-margin', default=15, type=int, help="Margin (px) of the proposed ROI above and below the brick")
+    parser.add_argument('--roi-min-edge', default=20.0, type=float, help="Minimum mean gradient of a localized brick edge")
 
     # Canny edge parameters
-    parser.add_argument('--blur-kernel-canny', default=[((0,0), 1.5), ((5,5), 0), ((7,7), 0)], type=list, help="List of blurring kernel sizes for canny edge detector")
-    parser.add_argument('--canny-thresh', default=[(30, 150), (50, 200), (210, 250)], type=list, help="List of thresholds for canny edge detector")
+    parser.add_argument('--blur-kernel-canny', default=[((0,0), 1.5), ((5,5), 0), ((7,7), 0)], nargs='+', type=blur_kernel, help="List of blurring kernels kx,ky,sigma for canny edge detector")
+    parser.add_argument('--canny-thresh', default=[(30, 150), (50, 200), (210, 250)], nargs='+', type=int_pair, help="List of thresholds low,high for canny edge detector")
     parser.add_argument('--voting-thresh', default=3, type=int, help="Voting threshold for canny edge voting")
 
     # Threshold masking parameters
@@ -41,23 +97,77 @@ def get_args_parser():
     # Hough transformation parameters
     parser.add_argument('--thresh-hough', default=220, type=int, help="Threshold of Hough line transformation")
     parser.add_argument('--thresh-cluster', default=40.0, type=float, help="Threshold of Non-Max-Suppression of Hough lines")
+    parser.add_argument('--hough-max-lines', default=256, type=int, help="Maximum number of Hough lines (strongest first) passed to the Non-Max-Suppression")
+    parser.add_argument('--hough-theta-range', default=(-30.0, 30.0), nargs=2, type=float, help="Range (min, max) of searched Hough line angles to the horizontal (deg), -90 90 for all angles")
 
     # Edge extractor parameters
-    parser.add_argument('--edge-horizontal-kernel', default=(5, 1), type=tuple, help="Kernel shape of horizontal edge extractor")
-    parser.add_argument('--edge-vertical-kernel', default=(1, 5), type=tuple, help="Kernel shape of vertical edge extractor")
+    parser.add_argument('--edge-horizontal-kernel', default=(5, 1), nargs=2, type=int, help="Kernel shape of horizontal edge extractor")
+    parser.add_argument('--edge-vertical-kernel', default=(1, 5), nargs=2, type=int, help="Kernel shape of vertical edge extractor")
     parser.add_argument('--edge-thresh', default=1, type=int, help="Threshold of edge extractor")
     parser.add_argument('--edge-nsteps', default=3, type=int, help="Number of vertical/horizontal lines of edge extractor")
     parser.add_argument('--edge-stepsize', default=10, type=int, help="Distance between each line of edge extractor")
 
+    # Depth sampling parameters
+    parser.add_argument('--depth-window', default=9, type=int, help="Size of the neighborhood of the median depth of each feature point")
+
+    # Plane fit parameters
+    parser.add_argument('--plane-stride', default=2, type=int, help="Sampling stride (px) of the depth pixels of the plane fit")
+    parser.add_argument('--plane-outlier', default=3.0, type=float, help="Outlier threshold of the plane fit relative to the median residual")
+    parser.add_argument('--plane-inliers', default=0.6, type=float, help="Minimum inlier ratio of the fitted front face plane")
+
     # Camera intrinsics
     parser.add_argument('--fx', default=434.5079345703125, type=float, help="Focal length in x-direction fx")
     parser.add_argument('--fy', default=434.5079345703125, type=float, help="Focal length in y-direction fy")
     parser.add_argument('--px', default=427.6170654296875, type=float, help="Principal point x-coordinate px")
     parser.add_argument('--py', default=238.77597045898438, type=float, help="Principal point y-coordinate py")
+    parser.add_argument('--dist', default=None, nargs='+', type=float, help="Distortion coefficients (k1 k2 p1 p2 [k3 ...]) of the camera, images are undistorted before the ROI")
+    parser.add_argument('--profiles', default=None, type=str, help="JSON file of named calibration profiles {camera: {parameter: value}} selected per request")
+    parser.add_argument('--camera', default=None, type=str, help="Calibration profile used if a request selects none")
+
+    # Tracking parameters of the stream mode
+    parser.add_argument('--track-margin', default=15, type=int, help="Margin (px) of the tracking window around the brick of the previous frame")
+    parser.add_argument('--track-theta', default=3.0, type=float, help="Searched Hough line angles (deg) around the pitch of the previous frame")
+    parser.add_argument('--track-gate', default=30.0, type=float, help="Maximum position change (mm) between frames before tracking is considered lost")
+    parser.add_argument('--track-angle-gate', default=15.0, type=float, help="Maximum roll/pitch/yaw change (deg) between frames before tracking is considered lost")
+    parser.add_argument('--track-smoothing', default=0.5, type=float, help="Weight of the current frame in the exponential pose smoothing, 1 to disable")
+
+    # Validation parameters
+    parser.add_argument('--min-depth-coverage', default=0.5, type=float, help="Minimum ratio of valid depth pixels in the ROI")
+    parser.add_argument('--edge-ratio', default=[0.002, 0.3], nargs=2, type=float, help="Range (min, max) of the ratio of edge pixels in the canny/SAM edge mask")
+
+    # Job queue parameters
+    parser.add_argument('--cv-workers', default=2, type=int, help="Number of worker threads of the CV job lane")
+    parser.add_argument('--sam-workers', default=1, type=int, help="Number of worker threads of the SAM job lane")
+    parser.add_argument('--cv-queue-size', default=64, type=int, help="Maximum number of queued CV jobs")
+    parser.add_argument('--sam-queue-size', default=8, type=int, help="Maximum number of queued SAM jobs")
+    parser.add_argument('--job-ttl', default=300.0, type=float, help="Time (s) finished jobs are kept for polling")
+    parser.add_argument('--job-history', default=256, type=int, help="Maximum number of finished jobs kept for polling, the oldest are dropped first")
+
+    # Response parameters
+    parser.add_argument('--image-format', default="png", choices=RESPONSE_FORMATS, help="Result image in the response: encoded as png/jpeg/webp, none, or lazy (fetched from /images/<image_id>)")
+    parser.add_argument('--image-quality', default=90, type=int, help="Quality (0-100) of jpeg/webp result images")
+    parser.add_argument('--image-cache', default=64, type=int, help="Maximum number of cached result images of the lazy format")
+    parser.add_argument('--image-ttl', default=60.0, type=float, help="Time (s) result images of the lazy format are cached")
+
+    # Instrumentation parameters
+    parser.add_argument('--metrics', action='store_true', help="Record stage timings of every request for the /metrics endpoint")
+    parser.add_argument('--profile-memory', action='store_true', help="Trace peak memory per stage (slows down all requests)")
+
+    if not defaults:
+        for action in parser._actions:
+            action.default = argparse.SUPPRESS
 
     return parser
 
 
+def validate_args(parser, args):
+    """Reject contradicting options of the parsed arguments."""
+    if args.sam_quantize and args.sam_backend != "onnx":
+        parser.error("--sam-quantize requires --sam-backend onnx")
+
+    return args
+
+
 app = Flask(__name__)
 
 
@@ -65,37 +175,331 @@ app = Flask(__name__)
 def index():
     return render_template('upload.html')  # Render the HTML form
 
+def single_process(view):
+    """Disable a route whose state lives in the serving process with --workers > 1,
+    a follow-up request would land on another worker process."""
+    @wraps(view)
+    def wrapper(*view_args, **view_kwargs):
+        if PREFORKED:
+            return jsonify({'error': f"{request.path} requires a single worker process (--workers 1)"}), 501
+        return view(*view_args, **view_kwargs)
+
+    return wrapper
+
+def read_request():
+    """Return mode, color image, depth image, profile flag and response options of a pose estimation request."""
+    # Uploads are decoded in memory straight from the request stream
+    color_image = request.files['color_image'].read()
+    depth_image = request.files['depth_image'].read()
+
+    # Per-request settings never modify the shared args
+    mode = request.form.get('mode') or ("sam" if request.form.get('bool_sam') == "true" else "cv")
+    profile = request.form.get('profile') == "true"
+    options = {}
+    if request.form.get('image_format'):
+        options["image_format"] = request.form['image_format']
+    if request.form.get('image_quality'):
+        options["image_quality"] = request.form.get('image_quality', type=int)
+    if request.form.get('mask_backend'):
+        options["mask_backend"] = request.form['mask_backend']
+    if request.form.get('camera'):
+        options["camera"] = request.form['camera']
+
+    return mode, color_image, depth_image, profile, options
+
+def request_error(mode, options):
+    """Error message of invalid request settings, None if they are valid."""
+    if mode not in PIPELINES:
+        return f"Unknown mode, choose from {', '.join(PIPELINES)}"
+    if options.get("image_format", args.image_format) not in RESPONSE_FORMATS:
+        return f"Unknown image format, choose from {', '.join(RESPONSE_FORMATS)}"
+    if PREFORKED and options.get("image_format", args.image_format) == "lazy":
+        return "The lazy image format requires a single worker process (--workers 1)"
+    if options.get("image_quality", args.image_quality) is None:
+        return "Image quality must be an integer"
+    if options.get("mask_backend", args.mask_backend) not in [*SEGMENTERS, "auto"]:
+        return f"Unknown mask backend, choose from {', '.join([*SEGMENTERS, 'auto'])}"
+    if "camera" in options and options["camera"] not in PROFILES:
+        return f"Unknown camera, choose from {', '.join(PROFILES) or 'none (no --profiles loaded)'}"
+
+    return None
+
+def request_config(options):
+    """Config of a request: the calibration profile of its camera with the request options."""
+    options = dict(options or {})
+    config = PROFILES[options.pop("camera")] if "camera" in options else args
+
+    return config.replace(**options) if options else config
+
+def estimate(mode, color_image, depth_image, profile, options=None):
+    """Run the pose estimation of a request and return the response and whether it succeeded."""
+    # Stage profiling if requested by the client or enabled for /metrics
+    profiler = Profiler(memory=args.profile_memory) if profile or args.metrics else NULL_PROFILER
+    request_args = request_config(options)
+
+    # Call the pose estimation method with the input images
+    try:
+        brick_pose = PIPELINES[mode](color_image, depth_image, request_args, profiler)
+
+    # On rejected pose estimation return the error code and message
+    except PoseValidationError as e:
+        if profiler is not NULL_PROFILER:
+            METRICS.observe(mode, profiler.report(), ok=False, code=e.code)
+        return e.to_dict(), False
+
+    # On insufficient/invalid pose estimation return error message
+    except AssertionError:
+        if profiler is not NULL_PROFILER:
+            METRICS.observe(mode, profiler.report(), ok=False)
+        return {"error": f"<pre>{traceback.format_exc()}</pre>"}, False
+
+    if profiler is not NULL_PROFILER:
+        report = profiler.report()
+        METRICS.observe(mode, report)
+        if profile:
+            brick_pose["profile"] = report
+    if "image_id" in brick_pose:
+        brick_pose["image_url"] = f"/images/{brick_pose['image_id']}"
+    if request_args.camera is not None:
+        brick_pose["camera"] = request_args.camera
+
+    return brick_pose, True
+
 @app.route('/process_images', methods=['GET', 'POST'])
 def process_images():
     # Check if both color and depth images are present in the request
     if 'color_image' not in request.files or 'depth_image' not in request.files:
         return jsonify({'error': 'Color image or depth image missing'}), 400
 
-    color_image = request.files['color_image']
-    depth_image = request.files['depth_image']
-    
-    args.sam = request.form.get('bool_sam') == "true"
+    request_args = read_request()
+    error = request_error(request_args[0], request_args[-1])
+    if error is not None:
+        return jsonify({'error': error}), 400
 
-    # Save images to disk before passing to pose estimation method
-    if not os.path.exists(args.savedir):
-        os.makedirs(args.savedir)
-    color_image.save(os.path.join(args.savedir, 'color.png'))
-    depth_image.save(os.path.join(args.savedir, 'depth.png'))
+    brick_pose, _ = estimate(*request_args)
 
-    # Call the pose estimation method with the input images
+    return brick_pose
+
+@app.route('/jobs', methods=['POST'])
+@single_process
+def submit_job():
+    # Check if both color and depth images are present in the request
+    if 'color_image' not in request.files or 'depth_image' not in request.files:
+        return jsonify({'error': 'Color image or depth image missing'}), 400
+
+    request_args = read_request()
+    error = request_error(request_args[0], request_args[-1])
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    # SAM jobs run in their own lane, the cheap pipelines and mask backends share the CV lane
+    sam = request_args[0] == "sam" and select_segmenter(request_config(request_args[-1])) == "sam"
+    lane = "sam" if sam else "cv"
     try:
-        if args.sam:
-            brick_pose = pose_estimation_sam(os.path.join(args.savedir, 'color.png'), os.path.join(args.savedir, 'depth.png'), args)
-        else:
-            brick_pose = pose_estimation_cv(os.path.join(args.savedir, 'color.png'), os.path.join(args.savedir, 'depth.png'), args)
+        job = JOB_QUEUE.submit(lane, estimate, *request_args)
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '1'}
 
-    # On insufficient/invalid pose estimation return error message
-    except AssertionError:
-        return {"error": f"<pre>{traceback.format_exc()}</pre>"}
+    return jsonify({**job.to_dict(), 'status_url': f"/jobs/{job.id}"}), 202
 
-    return brick_pose
+@app.route('/jobs/<job_id>', methods=['GET'])
+@single_process
+def get_job(job_id):
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+
+    # Optionally wait up to `wait` seconds for the job to finish (long polling)
+    job.done.wait(min(request.args.get('wait', 0, type=float), 30.0))
+
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+@single_process
+def stream_job(job_id):
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+
+    # Server-sent events with the job state on every status change until it is finished
+    def events():
+        status = None
+        while True:
+            if job.status != status:
+                status = job.status
+                yield f"event: {status}\ndata: {json.dumps(job.to_dict())}\n\n"
+            if job.done.is_set():
+                return
+            if not job.done.wait(1.0) and job.status == status:
+                yield ": keep-alive\n\n"
+
+    return Response(events(), mimetype='text/event-stream')
+
+@app.route('/images/<image_id>', methods=['GET'])
+@single_process
+def get_image(image_id):
+    """Result image of a request with the lazy image format, encoded on demand."""
+    img = IMAGE_CACHE.get(image_id)
+    if img is None:
+        return jsonify({'error': 'Unknown or expired image id'}), 404
+
+    fmt = request.args.get('format', 'png')
+    if fmt not in IMAGE_FORMATS:
+        return jsonify({'error': f"Unknown image format, choose from {', '.join(IMAGE_FORMATS)}"}), 400
+    quality = request.args.get('quality', args.image_quality, type=int)
+
+    return Response(encode_image(img, fmt, quality), mimetype=f"image/{fmt}")
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify(METRICS.snapshot())
+
+@app.route('/jobs', methods=['GET'])
+@single_process
+def jobs():
+    return jsonify(JOB_QUEUE.stats())
+
+@app.route('/models', methods=['GET'])
+def models():
+    return jsonify({**SAM_REGISTRY.stats(), "embedding_cache": EMBEDDING_CACHE.stats(), "image_cache": IMAGE_CACHE.stats(),
+                    "mask_backends": {name: {"cost_ms": cost, "accuracy": accuracy} for name, (cost, accuracy) in segmenter_costs(args).items()}})
+
+@app.route('/cameras', methods=['GET'])
+def cameras():
+    """Calibration profiles and the cache usage of their lookup tables."""
+    keys = ["fx", "fy", "px", "py", "dist", "roi_center", "roi_winsize", "brick_width", "brick_height", "brick_depth"]
+    caches = {"ray_grid": ray_grid, "undistort_maps": undistort_maps, "roi_slices": roi_slices}
+
+    return jsonify({
+        "default": args.camera,
+        "cameras": {name: {key: getattr(config, key) for key in keys} for name, config in PROFILES.items()},
+        "caches": {name: cache.cache_info()._asdict() for name, cache in caches.items()},
+    })
+
+def configure(parsed_args):
+    """Freeze the parsed arguments shared by all requests, load the calibration
+    profiles and set up the process-wide caches."""
+    global args, JOB_QUEUE, PROFILES
+    args = freeze(parsed_args)
+    try:
+        PROFILES = load_profiles(args.profiles, args, get_args_parser()) if args.profiles else {}
+    except ValueError as e:
+        sys.exit(str(e))
+    if args.camera is not None:
+        if args.camera not in PROFILES:
+            sys.exit(f"Unknown camera {args.camera}, choose from {', '.join(PROFILES) or 'none (no --profiles loaded)'}")
+        args = PROFILES[args.camera]
+    JOB_QUEUE = JobQueue(
+        workers={"cv": args.cv_workers, "sam": args.sam_workers},
+        maxsize={"cv": args.cv_queue_size, "sam": args.sam_queue_size},
+        ttl=args.job_ttl,
+        history=args.job_history,
+    )
+
+    SAM_REGISTRY.configure(ckpt_dir=args.sam_ckpt_dir, memory_budget=args.sam_memory_budget, onnx_dir=args.sam_onnx_dir,
+                           threads=args.sam_threads, inter_threads=args.sam_inter_threads)
+    EMBEDDING_CACHE.configure(args.sam_embedding_cache)
+    try:
+        measured_costs(args.mask_costs)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Invalid --mask-costs: {e}")
+    IMAGE_CACHE.configure(args.image_cache, args.image_ttl)
+
+    if args.profile_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    return args
+
+def serve(args):
+    """Serve the app with a multi-threaded server, or with pre-forked gunicorn
+    workers if --workers > 1. SAM backbones are loaded before serving."""
+    workers = args.workers or 1
+    if args.debug:
+        SAM_REGISTRY.warmup(args.sam_preload, backend=sam_backend(args))
+        app.run(host=args.host, port=args.port, debug=True)  # Run the Flask app in debug mode
+        return
+
+    if workers == 1:
+        from werkzeug.serving import run_simple
+        SAM_REGISTRY.warmup(args.sam_preload, backend=sam_backend(args))
+        run_simple(args.host, args.port, app, threaded=True)
+        return
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("gunicorn is required for --workers > 1")
+    if args.image_format == "lazy":
+        sys.exit("--image-format lazy requires a single worker process (--workers 1)")
+
+    # Set before forking, every worker process disables the process-local routes
+    global PREFORKED
+    PREFORKED = True
+    print("Job queue (/jobs) and lazy result images (/images) are disabled with --workers > 1", file=sys.stderr)
+
+    class PreforkApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("timeout", args.timeout)
+            self.cfg.set("preload_app", True)
+            # Warm up inference after the fork, the loaded weights are shared copy-on-write
+            self.cfg.set("post_worker_init", lambda worker: SAM_REGISTRY.warmup(args.sam_preload, backend=sam_backend(args)))
+
+        def load(self):
+            return app
+
+    SAM_REGISTRY.warmup(args.sam_preload, infer=False, backend=sam_backend(args))
+    PreforkApplication().run()
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser('Place quality system', parents=[get_args_parser()])
-    args = parser.parse_args()
-    app.run(debug=True)  # Run the Flask app in debug mode
+    parser = argparse.ArgumentParser('Place quality system', parents=[get_args_parser()], allow_abbrev=False)
+
+    # Serving parameters
+    parser.add_argument('--host', default="127.0.0.1", type=str, help="Host address of the HTTP server")
+    parser.add_argument('--port', default=5000, type=int, help="Port of the HTTP server")
+    parser.add_argument('--workers', default=None, type=int, help="Number of pre-forked worker processes (requires gunicorn if > 1), 1 by default")
+    parser.add_argument('--threads', default=4, type=int, help="Number of threads per pre-forked worker process")
+    parser.add_argument('--timeout', default=120, type=int, help="Timeout (s) of pre-forked worker processes")
+    parser.add_argument('--debug', action='store_true', help="Run the Flask development server in debug mode")
+    parser.add_argument('--startup-report', action='store_true', help="Print startup time, memory and imported heavy dependencies after preloading and exit")
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    # Offline batch estimation over a capture directory or manifest
+    batch_parser = subparsers.add_parser('batch', parents=[get_args_parser(defaults=False)], help="Run the pose estimation over a capture directory or manifest")
+    batch_parser.add_argument('input', type=str, help="Capture directory or manifest (.csv/.jsonl/.txt) of color/depth pairs")
+    batch_parser.add_argument('--output', default="results.jsonl", type=str, help="Result file, written as CSV if ending with .csv else as JSONL")
+    batch_parser.add_argument('--workers', default=argparse.SUPPRESS, type=int, help="Number of worker processes, defaults to number of cores")
+    batch_parser.add_argument('--sam', action='store_true', help="Run the SAM supported pose estimation")
+    batch_parser.add_argument('--plane', action='store_true', help="Run the plane-fit pose estimation")
+
+    # Frame-to-frame tracking over a frame sequence or video
+    stream_parser = subparsers.add_parser('stream', parents=[get_args_parser(defaults=False)], help="Track the pose over a frame sequence or video")
+    stream_parser.add_argument('input', type=str, help="Capture directory or manifest of color/depth frames, or color video file")
+    stream_parser.add_argument('--depth', default=None, type=str, help="Directory or list file of the depth frames of a color video")
+    stream_parser.add_argument('--output', default=None, type=str, help="Write the per frame results as JSONL, printed by default")
+    stream_parser.add_argument('--sam', action='store_true', help="Run the SAM supported pose estimation")
+    stream_parser.add_argument('--plane', action='store_true', help="Run the plane-fit pose estimation")
+
+    args = configure(validate_args(parser, parser.parse_args()))
+
+    if args.startup_report:
+        SAM_REGISTRY.warmup(args.sam_preload, backend=sam_backend(args))
+        print(json.dumps(startup_report(STARTED), indent=2))
+        sys.exit(0)
+
+    if args.command == 'batch':
+        summary = run_batch(find_pairs(args.input), args, output=args.output, workers=args.workers)
+        print(json.dumps(summary, indent=2))
+        sys.exit(0)
+
+    if args.command == 'stream':
+        with open(args.output, "w") if args.output else nullcontext(sys.stdout) as f:
+            for record in track(frame_source(args.input, args.depth), args):
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+        sys.exit(0)
+
+    serve(args)
@@ -0,0 +1,195 @@
+"""This module runs the pose estimation over whole capture directories
+with a process pool and streams the results to JSONL or CSV."""
+
+import os
+import csv
+import json
+import time
+import multiprocessing
+
+from .pose_estimation_cv import pose_estimation_cv
+from .pose_estimation_sam import pose_estimation_sam, pose_estimation_sam_batch
+from .pose_estimation_plane import pose_estimation_plane
+from .segmentation.backends import select_segmenter
+from .segmentation.sam_registry import sam_backend
+from .validation import PoseValidationError
+from .config import freeze
+
+IMAGE_EXTENSIONS = (".png", ".tif", ".tiff")
+CSV_FIELDS = ["color", "depth", "status", "x", "y", "z", "roll", "pitch", "yaw", "time_s", "error", "code"]
+
+_worker_args = None
+
+
+def find_pairs(source):
+    """Return the list of (color, depth) image paths of a capture directory or manifest.
+
+    A directory is searched recursively for images with "color" in their relative
+    path, the depth image is the same path with "color" replaced by "depth"
+    (e.g. 001_color.png/001_depth.png or color/001.png/depth/001.png).
+    A manifest is a CSV file with color and depth columns, a JSONL file with
+    color and depth keys or a text file with one whitespace separated pair per line.
+    Relative manifest paths are resolved against the manifest directory."""
+
+    if os.path.isdir(source):
+        pairs = []
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                rel = os.path.relpath(os.path.join(root, name), source)
+                if "color" not in rel or not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                depth = os.path.join(source, rel.replace("color", "depth"))
+                if os.path.exists(depth):
+                    pairs.append((os.path.join(source, rel), depth))
+        return sorted(pairs)
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="") as f:
+        if source.endswith(".csv"):
+            pairs = [(row["color"], row["depth"]) for row in csv.DictReader(f)]
+        elif source.endswith(".jsonl"):
+            pairs = [(item["color"], item["depth"]) for item in map(json.loads, filter(str.strip, f))]
+        else:
+            pairs = [tuple(line.split()[:2]) for line in f if line.strip() and not line.startswith("#")]
+
+    return [(os.path.join(base, color), os.path.join(base, depth)) for color, depth in pairs]
+
+
+def estimate_pair(pair, args):
+    """Run the pose estimation of a single (color, depth) pair and return a result record.
+        Failed estimations are reported in the record instead of being raised."""
+
+    color, depth = pair
+    record = {"color": color, "depth": depth}
+    start = time.perf_counter()
+    try:
+        res = (pose_estimation_sam if args.sam else pose_estimation_plane if args.plane else pose_estimation_cv)(color, depth, args)
+        record["status"] = "ok"
+        record["pose"] = {k: float(v) for k, v in res["pose"].items()}
+    # On insufficient/invalid pose estimation record error message
+    except AssertionError as e:
+        record["status"] = "failed"
+        record["error"] = str(e) or "AssertionError"
+        if isinstance(e, PoseValidationError):
+            record["code"] = e.code
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["time_s"] = round(time.perf_counter() - start, 4)
+
+    return record
+
+
+def estimate_pairs(pairs, args):
+    """Run the pose estimation of a chunk of (color, depth) pairs and return
+        their result records. In SAM mode the chunk shares SAM encoder batches."""
+
+    if not args.sam or len(pairs) == 1:
+        return [estimate_pair(pair, args) for pair in pairs]
+
+    start = time.perf_counter()
+    outputs = pose_estimation_sam_batch(pairs, args)
+    time_s = round((time.perf_counter() - start) / len(pairs), 4)
+
+    records = []
+    for (color, depth), res in zip(pairs, outputs):
+        record = {"color": color, "depth": depth}
+        if "error" in res:
+            record["status"] = "error" if "exception" in res else "failed"
+            record["error"] = res["error"]
+            if "code" in res:
+                record["code"] = res["code"]
+        else:
+            record["status"] = "ok"
+            record["pose"] = {k: float(v) for k, v in res["pose"].items()}
+        record["time_s"] = time_s
+        records.append(record)
+
+    return records
+
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+
+
+def _estimate_worker(chunk):
+    return estimate_pairs(chunk, _worker_args)
+
+
+def _write_record(writer, fmt, record):
+    if fmt == "csv":
+        row = {k: v for k, v in record.items() if k != "pose"}
+        row.update(record.get("pose", {}))
+        writer.writerow(row)
+    else:
+        writer.write(json.dumps(record) + "\n")
+
+
+def max_workers(args):
+    """Maximum number of worker processes in SAM mode, None otherwise. Every process
+    loads its own backbone running on all cores (or args.sam_threads of the ONNX
+    backend), more processes would oversubscribe the CPU."""
+
+    if not (args.sam and select_segmenter(args) == "sam"):
+        return None
+    cores = os.cpu_count() or 1
+    threads = args.sam_threads if sam_backend(args) != "torch" and args.sam_threads > 0 else cores
+
+    return max(1, cores // threads)
+
+
+def run_batch(pairs, args, output=None, workers=None, chunksize=1):
+    """Estimate the pose of all (color, depth) pairs with a pool of `workers`
+    processes (all cores by default, capped by max_workers in SAM mode). Results are streamed
+    in input order to `output` (.csv or .jsonl) as they complete. Returns a run summary.
+    In SAM mode pairs are dispatched in chunks of args.sam_batch_size."""
+
+    # Records hold the pose only, the result image is never drawn
+    args = freeze(args, image_format="none")
+    fmt = "csv" if output and output.endswith(".csv") else "jsonl"
+    f = open(output, "w", newline="") if output else None
+    writer = None
+    if f is not None:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS) if fmt == "csv" else f
+        if fmt == "csv":
+            writer.writeheader()
+
+    cap = max_workers(args)
+    workers = workers or cap or os.cpu_count() or 1
+    workers = min(workers, cap) if cap else workers
+    counts = {"ok": 0, "failed": 0, "error": 0}
+    latencies = []
+    size = args.sam_batch_size if args.sam else 1
+    chunks = [pairs[i:i + size] for i in range(0, len(pairs), size)]
+
+    start = time.perf_counter()
+    try:
+        if workers == 1:
+            results = (estimate_pairs(chunk, args) for chunk in chunks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(args,))
+            results = pool.imap(_estimate_worker, chunks, chunksize)
+        for record in (record for records in results for record in records):
+            counts[record["status"]] += 1
+            latencies.append(record["time_s"])
+            if writer is not None:
+                _write_record(writer, fmt, record)
+                f.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if f is not None:
+            f.close()
+    wall = time.perf_counter() - start
+
+    return {
+        "total": len(latencies),
+        "workers": workers,
+        **counts,
+        "wall_s": round(wall, 3),
+        "images_per_s": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+        "mean_latency_s": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+    }
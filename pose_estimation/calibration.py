@@ -0,0 +1,104 @@
+"""This module contains the named calibration profiles of a camera fleet. A profile
+overrides the intrinsics, distortion, ROI and brick parameters of the shared
+configuration, its derived lookup tables are cached per camera."""
+
+import json
+import argparse
+from functools import lru_cache
+
+import numpy as np
+import cv2
+
+from .config import freeze
+from .features.points import ray_grid
+from .utils.utils import roi_slices
+
+
+def load_profiles(path, args, parser):
+    """Load the calibration profiles of a JSON file {name: {parameter: value}}.
+    Parameters are the argument names of the parser (e.g. fx, roi_center, dist),
+    values are converted and validated like their command line values.
+    Returns an immutable config per profile. Lookup tables of profiles with an
+    image_size (width, height) are computed while loading."""
+
+    with open(path) as f:
+        profiles = json.load(f)
+
+    actions = {action.dest: action for action in parser._actions if action.dest not in ("help", "profiles", "camera")}
+    configs = {}
+    for name, overrides in profiles.items():
+        overrides = {key.replace("-", "_"): value for key, value in overrides.items()}
+        image_size = overrides.pop("image_size", None)
+        unknown = set(overrides) - set(actions)
+        if unknown:
+            raise ValueError(f"Unknown parameters {', '.join(sorted(unknown))} of calibration profile {name}")
+
+        try:
+            overrides = {key: parse_value(actions[key], value) for key, value in overrides.items()}
+        except (TypeError, ValueError, argparse.ArgumentTypeError) as e:
+            raise ValueError(f"Invalid parameter of calibration profile {name}: {e}") from None
+
+        configs[name] = freeze(args, camera=name, **overrides)
+        if image_size is not None:
+            warmup(configs[name], (image_size[1], image_size[0]))
+
+    return configs
+
+
+def parse_value(action, value):
+    """Convert a profile value like the command line value(s) of its parser action.
+    Numbers are parsed from their string, so e.g. 424.0 is no valid integer."""
+
+    key = action.option_strings[0]
+    if action.nargs == 0:
+        if not isinstance(value, bool):
+            raise TypeError(f"{key} must be true or false")
+        return value
+    if value is None and action.default is None:
+        return None
+
+    def convert(v):
+        v = action.type(v if isinstance(v, str) else str(v)) if action.type else v
+        if action.choices is not None and v not in action.choices:
+            raise ValueError(f"{key} must be one of {', '.join(map(str, action.choices))}")
+        return v
+
+    if action.nargs is None:
+        return convert(value)
+    if (not isinstance(value, list) or not value
+            or isinstance(action.nargs, int) and len(value) != action.nargs):
+        count = action.nargs if isinstance(action.nargs, int) else "one or more"
+        raise TypeError(f"{key} must be a list of {count} values")
+
+    return [convert(v) for v in value]
+
+
+def warmup(args, shape):
+    """Compute the cached lookup tables of a camera for images of shape (height, width)."""
+
+    ray_grid(shape, args.fx, args.fy, args.px, args.py)
+    roi_slices(tuple(args.roi_center), tuple(args.roi_winsize))
+    if args.dist:
+        undistort_maps(shape, args.fx, args.fy, args.px, args.py, tuple(args.dist))
+
+
+@lru_cache(maxsize=16)
+def undistort_maps(shape, fx, fy, px, py, dist):
+    """Undistortion maps of a camera for images of shape (height, width), cached per
+    image size, intrinsics and distortion. The undistorted images keep the camera
+    matrix, so the intrinsics of the back-projection stay valid."""
+
+    camera = np.array([[fx, 0, px], [0, fy, py], [0, 0, 1]], dtype=np.float64)
+
+    return cv2.initUndistortRectifyMap(camera, np.array(dist, dtype=np.float64), None, camera,
+                                       (shape[1], shape[0]), cv2.CV_16SC2)
+
+
+def undistort(color, depth, args):
+    """Undistort the color and depth image with the distortion coefficients args.dist.
+    Depth is resampled with nearest neighbors, so no depth values are interpolated."""
+
+    map1, map2 = undistort_maps(color.shape[:2], args.fx, args.fy, args.px, args.py, tuple(args.dist))
+
+    return (cv2.remap(color, map1, map2, cv2.INTER_LINEAR),
+            cv2.remap(depth, map1, map2, cv2.INTER_NEAREST))
@@ -0,0 +1,27 @@
+"""This module contains the immutable configuration passed through the pipeline stages."""
+
+from types import SimpleNamespace
+
+
+class Config(SimpleNamespace):
+    """Immutable namespace of pose estimation parameters. Stages read it like
+        the parsed argparse arguments, per-request values are set by creating
+        a new config with replace() so concurrent requests never share state."""
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Config is immutable, use replace({name}=...)")
+
+    def __delattr__(self, name):
+        raise AttributeError("Config is immutable")
+
+    def replace(self, **overrides):
+        return Config(**{**vars(self), **overrides})
+
+
+def freeze(args, **overrides):
+    """Return an immutable config of parsed arguments (or a config) with overrides."""
+
+    if isinstance(args, Config) and not overrides:
+        return args
+
+    return Config(**{**vars(args), **overrides})
@@ -7,41 +7,70 @@ from ..utils.utils import (
     cluster_lines,
     line_duplicator,
 )
+from ..utils.profiling import NULL_PROFILER
+from ..validation import check
 
-def hough_transformation(mask, top, bot, args):
-    """Extract horizontal hough lines from binary thresh mask"""
-    lines_xy = []
+# Decreasing Hough thresholds searched for the bottom edge line in SAM mode
+SAM_THRESH_HOUGH = np.arange(120, 0, -10)
+
+def hough_lines(mask, thresh, theta_range, max_lines):
+    """Return (rho, theta, votes) of the Hough lines with more than thresh votes
+    and an angle within theta_range, at most max_lines ordered by votes."""
+
+    lines = cv2.HoughLinesWithAccumulator(mask, 1, np.pi / 180, int(thresh), None, 0, 0, *theta_range)
+    if lines is None:
+        return np.empty((0, 3), dtype=np.float32)
+
+    return lines.reshape(-1, 3)[:max_lines]
+
+def line_points(lines, length=1000):
+    """Convert (rho, theta) Hough lines to end points length pixels on both sides
+    of the closest point to the origin, as integer point pairs."""
+
+    rho, theta = lines[:, 0], lines[:, 1]
+    a, b = np.cos(theta), np.sin(theta)
+    x0, y0 = a * rho, b * rho
+    pts = np.stack([x0 - length * b, y0 + length * a, x0 + length * b, y0 - length * a], axis=1).astype(int)
+
+    return [((x1, y1), (x2, y2)) for x1, y1, x2, y2 in pts.tolist()]
+
+def hough_transformation(mask, top, bot, args, profiler=NULL_PROFILER):
+    """Extract horizontal hough lines from binary thresh mask.
+    Only lines with an angle to the horizontal within args.hough_theta_range
+    (min, max) in degrees are searched, all angles if it is None.
+    In SAM mode the threshold is the highest of SAM_THRESH_HOUGH at which a line
+    below the ROI center is found. All thresholds are evaluated with a single
+    Hough transformation at the lowest threshold on the votes of its lines."""
+    center = args.roi_winsize[1] // 2
+    theta_range = (0, np.pi) if args.hough_theta_range is None else np.deg2rad(np.add(args.hough_theta_range, 90))
 
     if args.sam:
-        thresh_hough = 120 # args.thresh_hough
-        lines = None
-        while lines is None or not any([item[0][0] > 50 for item in lines]):
-            lines = cv2.HoughLines(mask, 1, np.pi / 180, thresh_hough, None, 0, 0)
-            thresh_hough -= 10
+        lines = hough_lines(mask, SAM_THRESH_HOUGH[-1], theta_range, args.hough_max_lines)
+        below = lines[lines[:, 0] > center, 2]
+        # Highest threshold with a line below the center, the lowest if there is none
+        thresh = SAM_THRESH_HOUGH[-1]
+        if below.size:
+            thresh = SAM_THRESH_HOUGH[np.argmax(SAM_THRESH_HOUGH < below.max())]
+        lines = lines[lines[:, 2] > thresh]
     else:
-        lines = cv2.HoughLines(mask, 1, np.pi / 180, args.thresh_hough, None, 0, 0)
-
-    for line in lines:
-        rho = line[0][0]
-        theta = line[0][1]
-        a = np.cos(theta)
-        b = np.sin(theta)
-        x0 = a * rho
-        y0 = b * rho
-        pt1 = (int(x0 + 1000*(-b)), int(y0 + 1000*(a)))
-        pt2 = (int(x0 - 1000*(-b)), int(y0 - 1000*(a)))
-        lines_xy.append((pt1, pt2))
+        lines = hough_lines(mask, args.thresh_hough, theta_range, args.hough_max_lines)
+    profiler.count("hough_calls")
+    check(len(lines), "hough_failed", "Hough transformation not successful")
+
+    lines_xy = line_points(lines)
 
     # Non-Max-Suppression of detected Hough lines
     clustered_lines = [line[0] for line in cluster_lines(lines_xy, args.thresh_cluster)]
+    profiler.count("hough_lines", len(lines_xy))
+    profiler.count("hough_clusters", len(clustered_lines))
 
     if args.sam:
         for line in clustered_lines:
-            if line[1][1] > 50:
+            if line[1][1] > center:
                 clustered_lines = [line]
 
     # Assert at least one, but at most to resulting hough lines for top and bottom edge
-    assert 1 <= len(clustered_lines) <= 2, "Hough transformation not successful"
+    check(1 <= len(clustered_lines) <= 2, "hough_failed", "Hough transformation not successful")
 
     # Translate top line to bottom edge and vice versa if only one edge is detected
     if len(clustered_lines) == 1:
@@ -49,38 +78,52 @@ def hough_transformation(mask, top, bot, args):
     # Arrange order of lines so that top edge line is first and bottom edge line is second
     else:
         slope = (clustered_lines[0][1][1] - clustered_lines[0][0][1]) / (clustered_lines[0][1][0] - clustered_lines[0][0][0])
-        if clustered_lines[0][0][1] - clustered_lines[0][0][0] * slope > 50:  # If bottom line first, switch
+        if clustered_lines[0][0][1] - clustered_lines[0][0][0] * slope > center:  # If bottom line first, switch
             clustered_lines[0], clustered_lines[1] = clustered_lines[1], clustered_lines[0]
     
     return clustered_lines
 
+def scan_edges(mask, positions, ksize, thresh):
+    """Search the first edge pixel above and below the mask center on all
+    vertical scan lines (columns) at once. A pixel is an edge if the sum of the
+    binary mask in a (height, width) `ksize` window around it reaches `thresh`.
+    Returns the row of the first hit towards the top and towards the bottom
+    per scan line, -1 if there is none."""
+
+    positions = np.asarray(positions, dtype=int)
+    hk, wk = ksize[0] // 2, ksize[1] // 2
+    center = mask.shape[0] // 2
+
+    # Window sums along all scan lines via cumulative sums of the column band around each line
+    cols = positions[:, None] + np.arange(-wk, wk + 1)
+    band = np.where((cols >= 0) & (cols < mask.shape[1]), mask[:, np.clip(cols, 0, mask.shape[1] - 1)], 0)
+    cumsum = np.zeros((mask.shape[0] + 2*hk + 1, len(positions)), dtype=np.int64)
+    np.cumsum(band.sum(axis=2, dtype=np.int64), axis=0, out=cumsum[hk+1:mask.shape[0]+hk+1])
+    cumsum[mask.shape[0]+hk+1:] = cumsum[mask.shape[0]+hk]
+    hits = (cumsum[2*hk+1:] - cumsum[:-2*hk-1]) >= thresh * 255
+    hits[:, (positions < 0) | (positions >= mask.shape[1])] = False
+
+    # First hit searching upwards and downwards from the center
+    up, down = hits[center::-1], hits[center:]
+    first = np.where(up.any(axis=0), center - up.argmax(axis=0), -1)
+    last = np.where(down.any(axis=0), center + down.argmax(axis=0), -1)
+
+    return first, last
+
+def scan_lines(center, args):
+    """Positions of the edge_nsteps scan lines spaced edge_stepsize around center."""
+
+    return center + args.edge_stepsize * np.arange(args.edge_nsteps) - args.edge_stepsize * (args.edge_nsteps - 1) // 2
+
 def horizontal_edge_extractor(mask, args):
     """Extract horizontal edges from binary mask
     starting the search from center of ROI"""
 
-    assert args.edge_nsteps%2 == 1, "Use odd number of steps"
-    ksize = args.edge_horizontal_kernel
-
-    x, y = mask.shape[1] // 2, mask.shape[0] // 2
-    top, bot = [], []
-
-    for w in range(x-args.edge_stepsize*(args.edge_nsteps//2), x+args.edge_stepsize*(args.edge_nsteps//2), args.edge_stepsize):
-        while y >= 0:
-            if np.sum(mask[y-ksize[0]//2:y+ksize[0]//2+1,w-ksize[1]//2:w+ksize[1]//2+1]) / 255 >= args.edge_thresh:
-                top.append((w, y))
-                break
-            y -= 1
-
-    x, y = mask.shape[1] // 2, mask.shape[0] // 2
-    for w in range(x-args.edge_stepsize*(args.edge_nsteps//2), x+args.edge_stepsize*(args.edge_nsteps//2), args.edge_stepsize):
-        while y <= mask.shape[1]:
-            if np.sum(mask[y-ksize[0]//2:y+ksize[0]//2+1,w-ksize[1]//2:w+ksize[1]//2+1]) / 255 >= args.edge_thresh:
-                bot.append((w, y))
-                break
-            y += 1
-
-    top = np.median([p[1] for p in top]).astype(int) if top else -1
-    bot = np.median([p[1] for p in bot]).astype(int) if bot else -1
+    top, bot = scan_edges(mask, scan_lines(mask.shape[1] // 2, args), args.edge_horizontal_kernel, args.edge_thresh)
+    top, bot = top[top >= 0], bot[bot >= 0]
+
+    top = np.median(top).astype(int) if top.size else -1
+    bot = np.median(bot).astype(int) if bot.size else -1
     
     return (top, bot)
 
@@ -88,30 +131,31 @@ def vertical_edge_extractor(mask, args):
     """Extract vertical edges from binary mask
     starting the search from center of ROI"""
 
-    assert args.edge_nsteps%2 == 1, "Use odd number of steps"
-    ksize = args.edge_vertical_kernel
-
-    x, y = mask.shape[1] // 2, mask.shape[0] // 2
-    left, right = [], []
-
-    for h in range(y-args.edge_stepsize*(args.edge_nsteps//2), y+args.edge_stepsize*(args.edge_nsteps//2), args.edge_stepsize):
-        while x >= 0:
-            if np.sum(mask[h-ksize[0]//2:h+ksize[0]//2+1,x-ksize[1]//2:x+ksize[1]//2+1]) / 255 >= args.edge_thresh:
-                left.append((x, h))
-                break
-            x -= 1
-
-    x, y = mask.shape[1] // 2, mask.shape[0] // 2
-    for h in range(y-args.edge_stepsize*(args.edge_nsteps//2), y+args.edge_stepsize*(args.edge_nsteps//2), args.edge_stepsize):
-        while x <= mask.shape[1]:
-            if np.sum(mask[h-ksize[0]//2:h+ksize[0]//2+1,x-ksize[1]//2:x+ksize[1]//2+1]) / 255 >= args.edge_thresh:
-                right.append((x, h))
-                break
-            x += 1
+    left, right = scan_edges(mask.T, scan_lines(mask.shape[0] // 2, args), args.edge_vertical_kernel[::-1], args.edge_thresh)
+    left, right = left[left >= 0], right[right >= 0]
 
-    left = np.median([p[0] for p in left]).astype(int) if left else -1
-    right = np.median([p[0] for p in right]).astype(int) if right else -1
+    left = np.median(left).astype(int) if left.size else -1
+    right = np.median(right).astype(int) if right.size else -1
 
-    assert left > 0 and right > 0, "No sufficient information for vertical edges"
+    check(left > 0 and right > 0, "vertical_edges", "No sufficient information for vertical edges")
     
-    return (left, right)
\ No newline at end of file
+    return (left, right)
+
+def edge_lines(mask, left, right, args):
+    """Fit the top and bottom edge lines to the edge hits of dense vertical scan lines
+    (every args.edge_stepsize // 2 pixels) between the left and right edge.
+    Hits further than 3 pixels from the median edge row are ignored.
+    Returns the lines as point pairs like hough_transformation, top line first."""
+
+    positions = np.arange(left + args.edge_stepsize, right - args.edge_stepsize + 1, max(args.edge_stepsize // 2, 1))
+    top, bot = scan_edges(mask, positions, args.edge_horizontal_kernel, args.edge_thresh)
+
+    lines = []
+    for hits in (top, bot):
+        valid = hits >= 0
+        valid &= np.abs(hits - np.median(hits[valid])) <= 3 if valid.any() else valid
+        check(np.count_nonzero(valid) >= 2, "horizontal_edges", "No sufficient information for horizontal edges")
+        slope, intercept = np.polyfit(positions[valid], hits[valid], 1)
+        lines.append(((0, int(round(intercept))), (mask.shape[1], int(round(intercept + slope * mask.shape[1])))))
+
+    return lines
@@ -0,0 +1,55 @@
+"""This module contains methods used to fit the brick front face plane to dense depth."""
+
+import numpy as np
+
+from .points import ray_grid
+from ..validation import check
+
+# Minimum number of valid depth pixels of a plane fit
+MIN_POINTS = 50
+
+
+def face_points(depth, box, args):
+    """Camera coordinates (n, 3) of all valid depth pixels inside the box
+    (left, top, right, bottom) in global image coordinates, sampled every
+    args.plane_stride pixels."""
+
+    left, top, right, bot = box
+    rays_x, rays_z = ray_grid(depth.shape[:2], args.fx, args.fy, args.px, args.py)
+    rows, cols = slice(top, bot, args.plane_stride), slice(left, right, args.plane_stride)
+    y = depth[rows, cols].astype(np.float64) / 10
+    valid = y > 0
+
+    return np.stack([rays_x[rows, cols][valid] * y[valid], y[valid], rays_z[rows, cols][valid] * y[valid]], axis=1)
+
+
+def fit_plane(points, args):
+    """Fit the plane y = a*x + b*z + c to camera coordinates (n, 3) by least squares.
+    Points with a residual above args.plane_outlier times the median absolute
+    residual (at least 1 mm) are dropped and the plane is refitted.
+    Returns (a, b, c) and the inlier ratio."""
+
+    check(len(points) >= MIN_POINTS, "plane_fit", "Insufficient depth information for plane fit")
+    design = np.column_stack([points[:, 0], points[:, 2], np.ones(len(points))])
+    inliers = np.ones(len(points), dtype=bool)
+
+    for _ in range(2):
+        coef = np.linalg.lstsq(design[inliers], points[inliers, 1], rcond=None)[0]
+        residuals = np.abs(design @ coef - points[:, 1])
+        inliers = residuals <= max(args.plane_outlier * np.median(residuals), 1.0)
+
+    return coef, np.count_nonzero(inliers) / len(points)
+
+
+def intersect_plane(img_coord_glob, plane, args, shape):
+    """Camera coordinates of image points as intersection of their rays with the plane."""
+
+    a, b, c = plane
+    rays_x, rays_z = ray_grid(shape[:2], args.fx, args.fy, args.px, args.py)
+    cam_coord = {}
+    for k, (u, v) in img_coord_glob.items():
+        rx, rz = rays_x[v, u], rays_z[v, u]
+        y = c / (1 - a * rx - b * rz)
+        cam_coord[k] = (rx * y, y, rz * y)
+
+    return cam_coord
@@ -1,8 +1,12 @@
 """This module contains methods used to extract the estimated image and
 camera coordinates from features."""
 
+from functools import lru_cache
+
 import numpy as np
 
+from ..validation import check
+
 def feats2points(left, right, lines):
     """Adapt image coordinates according to features."""
     points = {}
@@ -24,23 +28,66 @@ def feats2points(left, right, lines):
 
     return points
 
+# Direction towards the brick center of each feature point (x, y), depth is sampled inside the brick
+INWARD = {"mid": (0, 0), "top": (0, 1), "bot": (0, -1), "left": (1, 0), "right": (-1, 0)}
+
+@lru_cache(maxsize=64)
+def ray_grid(shape, fx, fy, px, py):
+    """Per pixel ray (x, z) of a camera with depth y = 1, cached per image size and intrinsics."""
+    u = (np.arange(shape[1], dtype=np.float64) - px) / fx
+    v = (np.arange(shape[0], dtype=np.float64) - py) / fy
+    return np.broadcast_to(u, shape), np.broadcast_to(v[:, None], shape)
+
+def sample_depth(depth, points, window, offsets=None):
+    """Median depth (mm) of the valid pixels in a window x window neighborhood of all
+    points (x, y) at once. The neighborhoods are shifted by offsets times half
+    the window. Returns NaN for points without any valid depth pixel."""
+    points = np.asarray(points, dtype=int)
+    if offsets is not None:
+        points = points + np.asarray(offsets, dtype=int) * (window // 2 + 1)
+    steps = np.arange(window) - window // 2
+    rows = np.clip(points[:, 1, None, None] + steps[None, :, None], 0, depth.shape[0] - 1)
+    cols = np.clip(points[:, 0, None, None] + steps[None, None, :], 0, depth.shape[1] - 1)
+    patches = depth[rows, cols].reshape(len(points), -1).astype(np.float64)
+
+    # Median of the valid pixels, invalid pixels are sorted behind the valid ones
+    patches[patches <= 0] = np.inf
+    patches.sort(axis=1)
+    n = np.count_nonzero(np.isfinite(patches), axis=1)
+    idx = np.arange(len(points))
+    with np.errstate(invalid="ignore"):
+        median = (patches[idx, np.maximum(n - 1, 0) // 2] + patches[idx, n // 2]) / 2
+    return np.where(n > 0, median, np.nan) / 10
+
+def backproject(depth, points, args, offsets=None):
+    """Camera coordinates (x, y, z) of image points (x, y) from the median depth of their
+    args.depth_window neighborhood and the cached ray grid, as an (n, 3) array."""
+    points = np.asarray(points, dtype=int)
+    rays_x, rays_z = ray_grid(depth.shape[:2], args.fx, args.fy, args.px, args.py)
+    y = sample_depth(depth, points, args.depth_window, offsets)
+    return np.stack([rays_x[points[:, 1], points[:, 0]] * y, y, rays_z[points[:, 1], points[:, 0]] * y], axis=1)
+
 def imgcoord2camcoord(depth, img_coord_glob, args):
-    """Transform image coordinates to camera coordinates with camera intrinsics and depth image"""
-    cam_coord = {}
-    for k, v in img_coord_glob.items():
-        y = depth[v[1], v[0]] / 10
-        x = (v[0] - args.px) * y / args.fx
-        z = (v[1] - args.py) * y / args.fy
-        cam_coord[k] = (x, y, z)
-
-    assert ((args.brick_width - 15 <= (cam_coord["right"][0]-cam_coord["left"][0]) <= args.brick_width + 15) or     # check width for normal stone
-            (args.brick_depth - 10 <= (cam_coord["right"][0]-cam_coord["left"][0]) <= args.brick_depth + 10) or     # check width for corner stone
-            (args.brick_height - 10 <= (cam_coord["bot"][-1]-cam_coord["bot"][-1]) <= args.brick_height + 10)), "Pose uncertain: invalid coordinate estimation"
-    
-    if args.brick_depth - 10 <= (cam_coord["right"][0]-cam_coord["left"][0]) <= args.brick_depth + 10:
-        args.corner_stone = True
-    else:
-        args.corner_stone = False
+    """Transform image coordinates to camera coordinates with camera intrinsics and depth image.
+    Depth of each point is the median of the valid depth pixels in a neighborhood inside the brick.
+    Returns the camera coordinates and whether the brick is a corner stone."""
+    keys = list(img_coord_glob)
+    coords = backproject(depth, [img_coord_glob[k] for k in keys], args, [INWARD.get(k, (0, 0)) for k in keys])
+    invalid = [k for k, y in zip(keys, coords[:, 1]) if not y > 0]
+    check(not invalid, "invalid_depth", f"Invalid depth at {', '.join(invalid)} point")
+    cam_coord = {k: tuple(c) for k, c in zip(keys, coords)}
+
+    corner_stone = check_dimensions(cam_coord, args)
     
-    return cam_coord
+    return cam_coord, corner_stone
 
+def check_dimensions(cam_coord, args):
+    """Check the measured brick dimensions of the camera coordinates of the feature points.
+    Returns whether the brick is a corner stone."""
+    height = cam_coord["bot"][-1] - cam_coord["top"][-1]
+    check(height >= args.brick_height / 2, "invalid_coordinates", f"Pose uncertain: brick height {height:.1f} mm too small")
+    check(((args.brick_width - 15 <= (cam_coord["right"][0]-cam_coord["left"][0]) <= args.brick_width + 15) or     # check width for normal stone
+            (args.brick_depth - 10 <= (cam_coord["right"][0]-cam_coord["left"][0]) <= args.brick_depth + 10) or     # check width for corner stone
+            (args.brick_height - 10 <= height <= args.brick_height + 10)), "invalid_coordinates", "Pose uncertain: invalid coordinate estimation")
+    
+    return args.brick_depth - 10 <= (cam_coord["right"][0]-cam_coord["left"][0]) <= args.brick_depth + 10
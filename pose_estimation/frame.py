@@ -0,0 +1,39 @@
+"""This module contains the frame setup shared by all pose estimation pipelines."""
+
+import cv2
+
+from .utils.utils import load_image, roi
+from .calibration import undistort
+from .localization import localize_roi
+from .validation import check, check_depth_coverage
+
+
+def prepare_frame(color, depth, args, profiler):
+    """Decode, validate and undistort a color and depth image, propose the ROI with
+    args.adaptive_roi and crop it. Returns the color ROI, the full depth image and the
+    config of the ROI. Frames without sufficient depth in the ROI are rejected
+    before any segmentation runs."""
+
+    with profiler.stage("decode"):
+        color, depth = load_image(color), load_image(depth, cv2.IMREAD_UNCHANGED)
+
+    check(color is not None, "decode_error", "Color image could not be decoded")
+    check(depth is not None, "decode_error", "Depth image could not be decoded")
+    check(color.shape[:2] == depth.shape[:2], "shape_mismatch", "Different shape of color and depth image")
+
+    # Lens distortion of the camera profile, undistorted with cached maps
+    if args.dist:
+        with profiler.stage("undistort"):
+            color, depth = undistort(color, depth, args)
+
+    # Coarse brick localization proposing the ROI
+    if args.adaptive_roi:
+        with profiler.stage("localize"):
+            args = localize_roi(color, depth, args, profiler)
+
+    # ROI definition, rejected early without sufficient depth information
+    with profiler.stage("roi"):
+        color_roi = roi(color, args)
+        check_depth_coverage(roi(depth, args), args)
+
+    return color_roi, depth, args
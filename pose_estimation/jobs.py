@@ -0,0 +1,130 @@
+"""This module contains an in-process job queue with separate worker lanes,
+so long-running SAM estimations do not block cheap CV estimations."""
+
+import os
+import time
+import uuid
+import queue
+import threading
+
+
+class QueueFull(Exception):
+    """Raised when the queue of a lane is full."""
+
+
+class Job:
+    """State of a submitted estimation job."""
+
+    def __init__(self, lane, fn, args):
+        self.id = uuid.uuid4().hex
+        self.lane = lane
+        self.status = "queued"
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self._fn = fn
+        self._args = args
+
+    def run(self):
+        self.status = "running"
+        self.started = time.time()
+        try:
+            self.result, ok = self._fn(*self._args)
+            self.status = "done" if ok else "failed"
+        except Exception as e:
+            self.result = {"error": f"{type(e).__name__}: {e}"}
+            self.status = "failed"
+        self.finished = time.time()
+        self._fn = self._args = None
+        self.done.set()
+
+    def to_dict(self):
+        res = {"job_id": self.id, "lane": self.lane, "status": self.status}
+        if self.started is not None:
+            res["queue_s"] = round(self.started - self.created, 3)
+        if self.finished is not None:
+            res["run_s"] = round(self.finished - self.started, 3)
+            res["result"] = self.result
+
+        return res
+
+
+class JobQueue:
+    """Bounded job queue with one worker pool per lane (e.g. "cv" and "sam").
+        Each lane has its own queue and worker threads, so jobs of one lane never
+        wait behind jobs of another. Finished jobs are kept for `ttl` seconds,
+        at most `history` of them (oldest dropped first).
+        Workers are started lazily in the process submitting the first job,
+        which keeps the queue usable in pre-forked server workers."""
+
+    def __init__(self, workers, maxsize, ttl=300.0, history=256):
+        self.workers = dict(workers)
+        self.maxsize = dict(maxsize)
+        self.ttl = ttl
+        self.history = history
+        self._queues = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, lane, fn, *args):
+        """Queue fn(*args) in `lane`, fn returns (result, ok). Raises QueueFull
+            if the lane queue is full."""
+        self._start()
+        job = Job(lane, fn, args)
+        try:
+            self._queues[lane].put_nowait(job)
+        except queue.Full:
+            raise QueueFull(f"Job queue of lane {lane} is full") from None
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            self._expire()
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "lanes": {
+                lane: {
+                    "workers": self.workers[lane],
+                    "queued": self._queues[lane].qsize() if lane in self._queues else 0,
+                    "maxsize": self.maxsize[lane],
+                } for lane in self.workers
+            },
+            "jobs": statuses,
+        }
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queues = {lane: queue.Queue(self.maxsize[lane]) for lane in self.workers}
+            for lane, n in self.workers.items():
+                for i in range(n):
+                    threading.Thread(target=self._work, args=(self._queues[lane],), name=f"{lane}-worker-{i}", daemon=True).start()
+
+    @staticmethod
+    def _work(jobs):
+        while True:
+            jobs.get().run()
+
+    def _expire(self):
+        now = time.time()
+        finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.finished)
+        expired = [job for job in finished if now - job.finished > self.ttl]
+        expired += finished[len(expired):max(len(finished) - self.history, len(expired))]
+        for job in expired:
+            del self._jobs[job.id]
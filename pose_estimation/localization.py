@@ -0,0 +1,108 @@
+"""This module contains the coarse localization of the brick of interest, which
+proposes a tight ROI before the segmentation runs."""
+
+from functools import lru_cache
+
+import numpy as np
+import cv2
+
+from .segmentation.segment import to_gray
+from .utils.utils import roi_window
+from .utils.profiling import NULL_PROFILER
+from .validation import check
+
+# Relative tolerance of the edge spacing to the expected brick size in pixels
+SPACING_TOL = 0.25
+
+
+def edge_pair(profile, spacing, min_edge, center):
+    """Find the pair of edges (i, j) in an edge strength profile with a spacing of
+    spacing (+-SPACING_TOL) whose middle is closest to center. Only pairs with at
+    least min_edge mean edge strength and half the strength of the strongest pair
+    are considered. Returns None if there is no such pair."""
+
+    offsets = np.arange(max(int(spacing * (1 - SPACING_TOL)), 1), int(np.ceil(spacing * (1 + SPACING_TOL))) + 1)
+    offsets = offsets[offsets < len(profile)]
+    if not offsets.size:
+        return None
+
+    # Pair strength per (offset, first edge), pairs reaching beyond the profile are invalid
+    scores = np.full((len(offsets), len(profile)), -np.inf)
+    for k, d in enumerate(offsets):
+        scores[k, :-d] = np.minimum(profile[:-d], profile[d:])
+
+    valid = scores >= max(min_edge, 0.5 * scores.max())
+    if not valid.any():
+        return None
+
+    k, i = np.nonzero(valid)
+    best = np.argmin(np.abs(i + offsets[k] / 2 - center))
+
+    return i[best], i[best] + offsets[k[best]]
+
+
+def localize_roi(color, depth, args, profiler=NULL_PROFILER):
+    """Propose a tight ROI around the brick of interest. The expected brick size in
+    pixels is derived from the depth at the ROI center. The horizontal and vertical
+    brick edges are searched as pairs of gradient maxima of this spacing on a
+    downsampled search window (args.roi_search times the configured ROI) around the
+    configured ROI center. Returns the config with the proposed ROI, the height is
+    reduced to the brick height plus args.roi_margin. Asserts early if no brick is found."""
+
+    profiler.count("localize_calls")
+    window = search_window(color.shape[:2], tuple(args.roi_center), tuple(args.roi_winsize), args.roi_search)
+    found = _localize(color, depth, window, args)
+    check(found is not None, "no_brick", "No brick found in ROI search window")
+
+    center, height = found
+
+    return roi_window(args, center, (args.roi_winsize[0], height + 2 * args.roi_margin), color.shape)
+
+
+@lru_cache(maxsize=64)
+def search_window(shape, roi_center, roi_winsize, scale):
+    """Center and even size of the search window of a camera setup, inside the image."""
+
+    w, h = int(roi_winsize[0] * scale) // 2 * 2, int(roi_winsize[1] * scale) // 2 * 2
+    w, h = min(w, shape[1] // 2 * 2), min(h, shape[0] // 2 * 2)
+    center = (int(np.clip(roi_center[0], w // 2, shape[1] - w // 2)), int(np.clip(roi_center[1], h // 2, shape[0] - h // 2)))
+
+    return center, (w, h)
+
+
+def _localize(color, depth, window, args):
+    (cx, cy), (w, h) = window
+    x0, y0 = cx - w // 2, cy - h // 2
+    factor = 2 ** args.roi_pyramid
+
+    # Expected brick size (px) at the median valid depth around the window center
+    patch = depth[cy - h // 8:cy + h // 8 + 1, cx - w // 8:cx + w // 8 + 1]
+    patch = patch[patch > 0]
+    check(patch.size, "no_valid_depth", "No valid depth in ROI")
+    y = np.median(patch) / 10
+    height = args.fy * args.brick_height / y / factor
+    widths = [args.fx * args.brick_width / y / factor, args.fx * args.brick_depth / y / factor]
+
+    # Gradient magnitudes on the downsampled search window
+    small = to_gray(color[y0:y0 + h, x0:x0 + w])
+    for _ in range(args.roi_pyramid):
+        small = cv2.pyrDown(small)
+    grad_y = np.abs(cv2.Sobel(small, cv2.CV_32F, 0, 1, ksize=3))
+    grad_x = np.abs(cv2.Sobel(small, cv2.CV_32F, 1, 0, ksize=3))
+
+    # Top and bottom edge on the central columns of the window
+    band = slice(max(small.shape[1] // 2 - int(widths[1]) // 2, 0), small.shape[1] // 2 + int(widths[1]) // 2 + 1)
+    rows = edge_pair(grad_y[:, band].mean(axis=1), height, args.roi_min_edge, small.shape[0] / 2)
+    if rows is None:
+        return None
+
+    # Left and right edge between top and bottom edge, normal stone or corner stone
+    profile = grad_x[rows[0] + 1:rows[1]].mean(axis=0)
+    cols = [edge_pair(profile, width, args.roi_min_edge, small.shape[1] / 2) for width in widths]
+    cols = [c for c in cols if c is not None]
+    col = min(cols, key=lambda c: abs((c[0] + c[1]) / 2 - small.shape[1] / 2)) if cols else None
+
+    center_x = x0 + (col[0] + col[1]) / 2 * factor if col is not None else cx
+    center_y = y0 + (rows[0] + rows[1]) / 2 * factor
+
+    return (int(center_x), int(center_y)), int((rows[1] - rows[0]) * factor)
@@ -1,62 +1,79 @@
 """This module runs the pose estimation script"""
 
-import cv2
-
 from .utils.utils import (
-    roi,
     roi2glob,
     angle_from_points,
     angle_from_lines,
     draw_feats,
     output_parser,
 )
-from .segmentation.segment import segment_canny, segment_thresh
+from .segmentation.segment import to_gray, segment_canny, segment_thresh
 from .features.feature_extractor import (
     horizontal_edge_extractor,
     vertical_edge_extractor,
     hough_transformation,
 )
 from .features.points import feats2points, imgcoord2camcoord
+from .validation import check_edge_count, check_angles
+from .utils.profiling import NULL_PROFILER
+from .config import freeze
+from .frame import prepare_frame
 
 
-def pose_estimation_cv(color_png, depth_png, args):
-    color, depth = cv2.imread(color_png), cv2.imread(depth_png, -1)
-
-    assert color is not None, "Color image file could not be read, check with os.path.exists()"
-    assert color is not None, "Depth image file could not be read, check with os.path.exists()"
-    assert color.shape[:2] == depth.shape[:2], "Different shape of color and depth image"
-    args.img_size = (color.shape[:2])
+def pose_estimation_cv(color, depth, args, profiler=NULL_PROFILER, feats=None):
+    """Estimate the brick pose from a color and depth image. Both images can be
+    given as decoded ndarrays, raw encoded byte buffers or file paths.
+    Stage timings and counters are recorded in `profiler`. If `feats` is a dict,
+    the detected points (global image coordinates) and Hough lines are stored in it."""
+    args = freeze(args, sam=False)
 
-    # ROI definition
-    color_roi = roi(color, args)
+    # Decoded and undistorted frame cropped to the (localized) ROI
+    color_roi, depth, args = prepare_frame(color, depth, args, profiler)
 
-    # Brick segmentation in ROI window
-    mask_canny = segment_canny(color_roi, args)
-    mask_thresh = segment_thresh(color_roi, args)
+    # Brick segmentation in ROI window on a shared grayscale image
+    with profiler.stage("segmentation"):
+        gray_roi = to_gray(color_roi)
+        mask_canny = segment_canny(gray_roi, args)
+        check_edge_count(mask_canny, args)
+        mask_thresh = segment_thresh(gray_roi, args)
 
     # Feature extraction from segmented brick in ROI window
-    top, bot = horizontal_edge_extractor(mask_canny, args)
-    left, right = vertical_edge_extractor(mask_canny, args)
-    hough_lines = hough_transformation(mask_thresh, top, bot, args)
+    with profiler.stage("edges"):
+        top, bot = horizontal_edge_extractor(mask_canny, args)
+        left, right = vertical_edge_extractor(mask_canny, args)
+    with profiler.stage("hough"):
+        hough_lines = hough_transformation(mask_thresh, top, bot, args, profiler)
 
     # True point adaption
-    img_coord_roi = feats2points(left, right, hough_lines)
+    with profiler.stage("points"):
+        img_coord_roi = feats2points(left, right, hough_lines)
 
-    # Draw features in output image
-    draw_roi = draw_feats(color_roi, img_coord_roi, hough_lines)
+    # Draw features on a copy of the ROI if the result image is requested
+    draw_roi = None
+    if args.image_format != "none":
+        with profiler.stage("draw"):
+            draw_roi = draw_feats(color_roi, img_coord_roi, hough_lines)
 
-    # Re-transformation of ROI coordinates to global image coordinates
-    img_coord_glob = roi2glob(img_coord_roi, args)
+    with profiler.stage("projection"):
+        # Re-transformation of ROI coordinates to global image coordinates
+        img_coord_glob = roi2glob(img_coord_roi, args)
 
-    # Camera coordinates from image coordinates, camera intrinsics and depth image
-    cam_coord = imgcoord2camcoord(depth, img_coord_glob, args)
+        # Camera coordinates from image coordinates, camera intrinsics and depth image
+        cam_coord, corner_stone = imgcoord2camcoord(depth, img_coord_glob, args)
+
+    if feats is not None:
+        feats.update(points=img_coord_glob, lines=hough_lines, corner_stone=corner_stone)
 
     # Angles from camera coordinates and hough lines
-    roll = angle_from_points(cam_coord, angle="roll")
-    pitch = angle_from_lines(hough_lines)
-    yaw = angle_from_points(cam_coord, angle="yaw")
+    with profiler.stage("angles"):
+        roll = angle_from_points(cam_coord, angle="roll")
+        pitch = angle_from_lines(hough_lines)
+        yaw = angle_from_points(cam_coord, angle="yaw")
+
+        check_angles(roll, pitch, yaw)
 
     # JSON pose
-    output = output_parser(cam_coord, roll, pitch, yaw, draw_roi, args)
+    with profiler.stage("output"):
+        output = output_parser(cam_coord, roll, pitch, yaw, corner_stone, draw_roi, args)
 
-    return output
\ No newline at end of file
+    return output
@@ -0,0 +1,81 @@
+"""This module runs the plane-fit pose estimation script"""
+
+import numpy as np
+
+from .utils.utils import (
+    roi2glob,
+    angle_from_lines,
+    draw_feats,
+    output_parser,
+)
+from .segmentation.segment import to_gray, segment_canny_single
+from .features.feature_extractor import vertical_edge_extractor, edge_lines
+from .features.points import feats2points, check_dimensions
+from .features.plane import face_points, fit_plane, intersect_plane
+from .validation import check, check_edge_count, check_angles
+from .utils.profiling import NULL_PROFILER
+from .config import freeze
+from .frame import prepare_frame
+
+
+def pose_estimation_plane(color, depth, args, profiler=NULL_PROFILER, feats=None):
+    """Estimate the brick pose from a color and depth image by fitting the brick
+    front face plane to all valid depth pixels inside the detected brick edges.
+    Roll and yaw are derived from the plane, pitch from the top and bottom edge.
+    Uses a single canny mask instead of the canny voting and no Hough transformation.
+    Arguments and `feats` as for pose_estimation_cv."""
+    args = freeze(args, sam=False)
+
+    # Decoded and undistorted frame cropped to the (localized) ROI
+    color_roi, depth, args = prepare_frame(color, depth, args, profiler)
+
+    # Brick segmentation in ROI window
+    with profiler.stage("segmentation"):
+        mask = segment_canny_single(to_gray(color_roi), args)
+        check_edge_count(mask, args)
+
+    # Brick edges from dense scan lines
+    with profiler.stage("edges"):
+        left, right = vertical_edge_extractor(mask, args)
+        lines = edge_lines(mask, left, right, args)
+
+    with profiler.stage("points"):
+        img_coord_roi = feats2points(left, right, lines)
+        img_coord_glob = roi2glob(img_coord_roi, args)
+
+    # Front face plane from the depth pixels inside the brick edges
+    with profiler.stage("plane"):
+        margin = args.depth_window // 2 + 1
+        box = (img_coord_glob["left"][0] + margin, img_coord_glob["top"][1] + margin,
+               img_coord_glob["right"][0] - margin, img_coord_glob["bot"][1] - margin)
+        plane, inliers = fit_plane(face_points(depth, box, args), args)
+        check(inliers >= args.plane_inliers, "plane_fit", f"Front face not planar ({inliers:.0%} inliers)")
+        profiler.count("plane_points", int((box[2] - box[0]) * (box[3] - box[1]) // args.plane_stride**2))
+
+    # Draw features on a copy of the ROI if the result image is requested
+    draw_roi = None
+    if args.image_format != "none":
+        with profiler.stage("draw"):
+            draw_roi = draw_feats(color_roi, img_coord_roi, lines)
+
+    # Camera coordinates of the feature points on the front face plane
+    with profiler.stage("projection"):
+        cam_coord = intersect_plane(img_coord_glob, plane, args, depth.shape)
+        corner_stone = check_dimensions(cam_coord, args)
+
+    if feats is not None:
+        feats.update(points=img_coord_glob, lines=lines, corner_stone=corner_stone)
+
+    # Angles from the plane (y = a*x + b*z + c) and the edge lines
+    with profiler.stage("angles"):
+        roll = np.rad2deg(np.arctan(plane[1]))
+        pitch = angle_from_lines(lines)
+        yaw = np.rad2deg(np.arctan(plane[0]))
+
+        check_angles(roll, pitch, yaw)
+
+    # JSON pose
+    with profiler.stage("output"):
+        output = output_parser(cam_coord, roll, pitch, yaw, corner_stone, draw_roi, args)
+
+    return output
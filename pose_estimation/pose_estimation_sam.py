@@ -1,63 +1,132 @@
 """This module runs the pose estimation script"""
 
-import cv2
 import numpy as np
 
 from .utils.utils import (
-    roi,
     roi2glob,
     draw_feats,
     angle_from_points,
     angle_from_lines,
     output_parser
 )
-from .segmentation.segment import segment_sam, segment_canny
+from .segmentation.segment import segment_canny, mask2edges
+from .segmentation.backends import segment_masks, select_segmenter
 from .features.feature_extractor import (
     horizontal_edge_extractor,
     vertical_edge_extractor,
     hough_transformation,
 )
 from .features.points import feats2points, imgcoord2camcoord
+from .validation import PoseValidationError, check_edge_count, check_angles
+from .utils.profiling import NULL_PROFILER
+from .config import freeze
+from .frame import prepare_frame
 
 
-def pose_estimation_sam(color_png, depth_png, args):
-    color, depth = cv2.imread(color_png), cv2.imread(depth_png, -1)
+def pose_estimation_sam(color, depth, args, profiler=NULL_PROFILER, feats=None):
+    """Estimate the brick pose from a color and depth image. Both images can be
+    given as decoded ndarrays, raw encoded byte buffers or file paths.
+    The brick mask is segmented by SAM or the backend of args.mask_backend.
+    Stage timings and counters are recorded in `profiler`. If `feats` is a dict,
+    the detected points (global image coordinates) and Hough lines are stored in it."""
+    args = freeze(args, sam=True)
+    # Decoded and undistorted frame cropped to the (localized) ROI
+    color_roi, depth, args = prepare_frame(color, depth, args, profiler)
 
-    assert color is not None, "Color image file could not be read, check with os.path.exists()"
-    assert color is not None, "Depth image file could not be read, check with os.path.exists()"
-    assert color.shape[:2] == depth.shape[:2], "Different shape of color and depth image"
-    args.img_size = (color.shape[:2])
+    # Brick segmentation in ROI window
+    with profiler.stage(f"segment_{select_segmenter(args)}"):
+        mask_sam = mask2edges(segment_masks([color_roi], args)[0])
+
+    return _estimate(color_roi, depth, mask_sam, args, profiler, feats)
+
+
+def pose_estimation_sam_batch(pairs, args, profiler=NULL_PROFILER):
+    """Estimate the brick poses of multiple (color, depth) pairs. The SAM image
+    encoder runs on batches of up to args.sam_batch_size ROIs. Returns one
+    output per pair, failed estimations are returned as {"error": message} (with "code" if rejected,
+    "exception" for other errors, e.g. of a failed segmentation of all pairs).
+    Stage timings of all pairs are accumulated in `profiler`."""
+    args = freeze(args, sam=True)
+    outputs = [None] * len(pairs)
+    prepared = []
+    for i, (color, depth) in enumerate(pairs):
+        try:
+            prepared.append((i, *prepare_frame(color, depth, args, profiler)))
+        except Exception as e:
+            outputs[i] = _failure(e)
+
+    # Brick segmentation in all ROI windows, no backbone is loaded if all frames were rejected
+    masks_sam = []
+    if prepared:
+        try:
+            with profiler.stage(f"segment_{select_segmenter(args)}"):
+                masks_sam = [mask2edges(mask) for mask in segment_masks([color_roi for _, color_roi, _, _ in prepared], args)]
+        except Exception as e:
+            for i, *_ in prepared:
+                outputs[i] = _failure(e)
+
+    for (i, color_roi, depth, roi_args), mask_sam in zip(prepared, masks_sam):
+        try:
+            outputs[i] = _estimate(color_roi, depth, mask_sam, roi_args, profiler)
+        except Exception as e:
+            outputs[i] = _failure(e)
+
+    return outputs
 
-    # ROI definition
-    color_roi = roi(color, args)
+
+def _failure(e):
+    if isinstance(e, PoseValidationError):
+        return e.to_dict()
+    if isinstance(e, AssertionError):
+        return {"error": str(e) or "AssertionError"}
+
+    return {"error": f"{type(e).__name__}: {e}", "exception": type(e).__name__}
+
+
+def _estimate(color_roi, depth, mask_sam, args, profiler, feats=None):
+    check_edge_count(mask_sam, args)
 
     # Brick segmentation in ROI window
-    mask_sam = segment_sam(color_roi, args)
-    mask_canny = segment_canny(color_roi, args)
+    with profiler.stage("segmentation"):
+        mask_canny = segment_canny(color_roi, args)
 
     # Feature extraction from segmented brick in ROI window
-    top, bot = horizontal_edge_extractor(mask_canny, args)
-    left, right = vertical_edge_extractor(mask_sam, args)
-    hough_lines = hough_transformation(mask_sam, top, bot, args)
+    with profiler.stage("edges"):
+        top, bot = horizontal_edge_extractor(mask_canny, args)
+        left, right = vertical_edge_extractor(mask_sam, args)
+    with profiler.stage("hough"):
+        hough_lines = hough_transformation(mask_sam, top, bot, args, profiler)
 
     # True point adaption
-    img_coord_roi = feats2points(left, right, hough_lines)
+    with profiler.stage("points"):
+        img_coord_roi = feats2points(left, right, hough_lines)
+
+    # Draw features on a copy of the ROI if the result image is requested
+    draw_roi = None
+    if args.image_format != "none":
+        with profiler.stage("draw"):
+            draw_roi = draw_feats(color_roi, img_coord_roi, hough_lines)
 
-    # Draw features in output image
-    draw_roi = draw_feats(color_roi, img_coord_roi, hough_lines)
+    with profiler.stage("projection"):
+        # Re-transformation of ROI coordinates to global image coordinates
+        img_coord_glob = roi2glob(img_coord_roi, args)
 
-    # Re-transformation of ROI coordinates to global image coordinates
-    img_coord_glob = roi2glob(img_coord_roi, args)
+        # Camera coordinates from image coordinates, camera intrinsics and depth image
+        cam_coord, corner_stone = imgcoord2camcoord(depth, img_coord_glob, args)
 
-    # Camera coordinates from image coordinates, camera intrinsics and depth image
-    cam_coord = imgcoord2camcoord(depth, img_coord_glob, args)
+    if feats is not None:
+        feats.update(points=img_coord_glob, lines=hough_lines, corner_stone=corner_stone)
 
     # Angles from camera coordinates and hough lines
-    roll = angle_from_points(cam_coord, angle="roll")
-    pitch = angle_from_lines(hough_lines)
-    yaw = angle_from_points(cam_coord, angle="yaw")
+    with profiler.stage("angles"):
+        roll = angle_from_points(cam_coord, angle="roll")
+        pitch = angle_from_lines(hough_lines)
+        yaw = angle_from_points(cam_coord, angle="yaw")
+
+        check_angles(roll, pitch, yaw)
 
     # JSON pose
-    output = output_parser(cam_coord, roll, pitch, yaw, draw_roi, args)
+    with profiler.stage("output"):
+        output = output_parser(cam_coord, roll, pitch, yaw, corner_stone, draw_roi, args)
 
-    return output
\ No newline at end of file
+    return output
@@ -0,0 +1,82 @@
+"""This module contains the interchangeable mask segmentation backends of the
+SAM pipeline. Each backend segments the brick of interest from the center
+prompt of an ROI and declares its cost, so the cheapest backend meeting an
+accuracy target can be selected."""
+
+import json
+from collections import namedtuple
+from functools import lru_cache
+
+from .segment import segment_floodfill, segment_watershed, sam_mask, sam_predict_batch
+from .sam_registry import sam_backend
+
+# segment(imgs, args) returns one binary uint8 mask per ROI. cost_ms is the mean
+# time per 400x100 ROI on a single CPU core and accuracy the mean IoU with the
+# ground truth brick face on the synthetic benchmark scenes (benchmark --check-segmenters)
+Segmenter = namedtuple("Segmenter", ["segment", "cost_ms", "accuracy"])
+
+
+def _per_roi(segment):
+    return lambda imgs, args: [segment(img, args) for img in imgs]
+
+
+def _sam(imgs, args):
+    return [sam_mask(sam_masks, scores) for sam_masks, scores in sam_predict_batch(imgs, args)]
+
+
+SEGMENTERS = {
+    "floodfill": Segmenter(_per_roi(segment_floodfill), cost_ms=0.5, accuracy=0.997),
+    "watershed": Segmenter(_per_roi(segment_watershed), cost_ms=0.9, accuracy=0.992),
+    # Reference segmentation, the cost is the vit_b image encoder of SAM_COST_MS
+    "sam": Segmenter(_sam, cost_ms=23600.0, accuracy=1.0),
+}
+
+# Cost per ROI of the vit_b image encoder per SAM inference backend (args.sam_backend)
+SAM_COST_MS = {"torch": 23600.0, "onnx": 15000.0, "onnx-int8": 12100.0}
+
+
+@lru_cache(maxsize=None)
+def measured_costs(path):
+    """Measured {backend: {"cost_ms": ..., "accuracy": ...}} of a JSON file,
+    e.g. written by benchmark --write-mask-costs on the target hardware."""
+
+    if path is None:
+        return {}
+    with open(path) as f:
+        measured = json.load(f)
+    unknown = set(measured) - set(SEGMENTERS)
+    if unknown:
+        raise ValueError(f"Unknown mask backends {', '.join(sorted(unknown))} in {path}")
+
+    return measured
+
+
+def segmenter_costs(args):
+    """Cost (ms per ROI) and accuracy of each mask backend: the declared values,
+    with the SAM cost of the selected inference backend, overridden by the
+    measured values of args.mask_costs."""
+
+    costs = {name: (segmenter.cost_ms, segmenter.accuracy) for name, segmenter in SEGMENTERS.items()}
+    costs["sam"] = (SAM_COST_MS[sam_backend(args)], costs["sam"][1])
+    for name, measured in measured_costs(args.mask_costs).items():
+        costs[name] = (float(measured.get("cost_ms", costs[name][0])), float(measured.get("accuracy", costs[name][1])))
+
+    return costs
+
+
+def select_segmenter(args):
+    """Name of the mask segmentation backend of args.mask_backend. With "auto" the
+    cheapest backend with an accuracy of at least args.mask_accuracy (see segmenter_costs)."""
+
+    if args.mask_backend != "auto":
+        return args.mask_backend
+    costs = segmenter_costs(args)
+    candidates = [name for name, (_, accuracy) in costs.items() if accuracy >= args.mask_accuracy]
+
+    return min(candidates or ["sam"], key=lambda name: costs[name][0])
+
+
+def segment_masks(imgs, args):
+    """Segment the brick of interest in multiple ROIs with the selected backend."""
+
+    return SEGMENTERS[select_segmenter(args)].segment(imgs, args)
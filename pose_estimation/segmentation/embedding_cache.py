@@ -0,0 +1,75 @@
+"""This module contains a bounded cache of SAM image embeddings, so resubmitted
+frames only run the mask decoder."""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def embedding_key(img, backbone):
+    """Content hash of the ROI pixels combined with the backbone name."""
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{backbone}:{img.shape}:{img.dtype}".encode())
+    digest.update(np.ascontiguousarray(img))
+
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """Least recently used cache of image embeddings with hit/miss statistics."""
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize):
+        """Set the maximum number of cached embeddings, 0 disables the cache."""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+
+        return embedding
+
+    def put(self, key, embedding):
+        with self._lock:
+            if not self.maxsize:
+                return
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+EMBEDDING_CACHE = EmbeddingCache()
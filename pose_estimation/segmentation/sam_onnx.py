@@ -0,0 +1,199 @@
+"""This module contains the ONNX Runtime backend of the Segment Anything Model (SAM).
+The image encoder and the prompt encoder/mask decoder are exported to ONNX once
+per backbone and run on CPU without PyTorch, optionally with int8 weights."""
+
+import os
+import time
+import inspect
+import threading
+
+import numpy as np
+import cv2
+
+# Input resolution and pixel normalization of the SAM image encoder
+IMG_SIZE = 1024
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+MASK_THRESHOLD = 0.0
+OPSET = 17
+
+
+def onnx_paths(onnx_dir, name, quantize=False):
+    """Paths of the exported encoder and decoder models of a backbone."""
+
+    suffix = ".int8.onnx" if quantize else ".onnx"
+
+    return (os.path.join(onnx_dir, f"sam_{name}_encoder{suffix}"),
+            os.path.join(onnx_dir, f"sam_{name}_decoder{suffix}"))
+
+
+def export_onnx(model, encoder_path, decoder_path):
+    """Export the image encoder (dynamic batch size) and the prompt encoder and
+    mask decoder (dynamic number of points) of a loaded SAM model to ONNX.
+    The decoder returns the low resolution masks, they are upscaled in postprocess
+    as the traced mask upscaling of SamOnnxModel is fixed to the export image size."""
+
+    import torch
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    class SamDecoder(SamOnnxModel):
+        @torch.no_grad()
+        def forward(self, image_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+            masks, scores = self.model.mask_decoder.predict_masks(
+                image_embeddings=image_embeddings,
+                image_pe=self.model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=self._embed_points(point_coords, point_labels),
+                dense_prompt_embeddings=self._embed_masks(mask_input, has_mask_input),
+            )
+            return scores, masks
+
+    os.makedirs(os.path.dirname(encoder_path) or ".", exist_ok=True)
+    # The legacy TorchScript based exporter, newer PyTorch defaults to the dynamo exporter
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model.image_encoder,
+            torch.randn(1, 3, IMG_SIZE, IMG_SIZE),
+            encoder_path,
+            input_names=["images"],
+            output_names=["image_embeddings"],
+            dynamic_axes={"images": {0: "batch"}, "image_embeddings": {0: "batch"}},
+            opset_version=OPSET,
+            **kwargs,
+        )
+
+        embed_dim = model.prompt_encoder.embed_dim
+        embed_size = model.prompt_encoder.image_embedding_size
+        dummy_inputs = {
+            "image_embeddings": torch.randn(1, embed_dim, *embed_size),
+            "point_coords": torch.randint(0, IMG_SIZE, (1, 2, 2), dtype=torch.float),
+            "point_labels": torch.randint(0, 4, (1, 2), dtype=torch.float),
+            "mask_input": torch.randn(1, 1, *[4 * x for x in embed_size]),
+            "has_mask_input": torch.tensor([1], dtype=torch.float),
+        }
+        torch.onnx.export(
+            SamDecoder(model, return_single_mask=False),
+            tuple(dummy_inputs.values()),
+            decoder_path,
+            input_names=list(dummy_inputs),
+            output_names=["iou_predictions", "low_res_masks"],
+            dynamic_axes={"point_coords": {1: "num_points"}, "point_labels": {1: "num_points"}},
+            opset_version=OPSET,
+            **kwargs,
+        )
+
+
+def quantize_onnx(src, dst):
+    """Quantize the weights of the MatMul/Gemm layers of an ONNX model to int8,
+    activations are quantized dynamically at run time."""
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(src, dst, op_types_to_quantize=["MatMul", "Gemm"],
+                     per_channel=False, reduce_range=False, weight_type=QuantType.QUInt8)
+
+
+def session(path, threads=0, inter_threads=0):
+    """ONNX Runtime CPU session, 0 threads uses the ONNX Runtime default."""
+
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = inter_threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def resized_size(size):
+    """Size (h, w) of an image resized to a longest side of IMG_SIZE."""
+
+    scale = IMG_SIZE / max(size)
+
+    return int(size[0] * scale + 0.5), int(size[1] * scale + 0.5)
+
+
+def preprocess(img):
+    """Resize an image to a longest side of IMG_SIZE, normalize and zero pad it
+    to the (3, IMG_SIZE, IMG_SIZE) encoder input, as SamPredictor does."""
+
+    h, w = resized_size(img.shape[:2])
+    interpolation = cv2.INTER_LINEAR if h >= img.shape[0] else cv2.INTER_AREA
+    resized = cv2.resize(img, (w, h), interpolation=interpolation).astype(np.float32)
+    padded = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    padded[:h, :w] = (resized - PIXEL_MEAN) / PIXEL_STD
+
+    return padded.transpose(2, 0, 1), (h, w)
+
+
+def postprocess(low_res, input_size, original_size):
+    """Upscale low resolution mask logits (n, 256, 256) to the encoder input,
+    remove the padding and resize them to the original image size, as Sam.postprocess_masks."""
+
+    masks = cv2.resize(low_res.transpose(1, 2, 0), (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_LINEAR)
+    masks = masks.reshape(IMG_SIZE, IMG_SIZE, -1)[:input_size[0], :input_size[1]]
+    masks = cv2.resize(masks, (original_size[1], original_size[0]), interpolation=cv2.INTER_LINEAR)
+
+    return masks.reshape(original_size[0], original_size[1], -1).transpose(2, 0, 1)
+
+
+class OnnxSamEntry:
+    """A SAM backbone running on ONNX Runtime with the interface of SamEntry.
+        Embeddings are (features, original_size, input_size) with numpy features."""
+
+    def __init__(self, name, encoder_path, decoder_path, threads=0, inter_threads=0):
+        self.name = name
+        self.encoder = session(encoder_path, threads, inter_threads)
+        self.decoder = session(decoder_path, threads, inter_threads)
+        self.lock = threading.Lock()
+        self.load_time = 0.0
+        self.nbytes = os.path.getsize(encoder_path) + os.path.getsize(decoder_path)
+        self.last_used = time.monotonic()
+
+    def encode(self, imgs):
+        """Run the image encoder on a batch of images in one forward pass."""
+        inputs, sizes = zip(*[preprocess(img) for img in imgs])
+        features = self.encoder.run(None, {"images": np.stack(inputs)})[0]
+
+        # Copies, a cached view of one image would keep the features of the whole batch alive
+        return [(features[i:i+1].copy(), img.shape[:2], input_size) for i, (img, input_size) in enumerate(zip(imgs, sizes))]
+
+    def decode(self, embedding, point_coords, point_labels):
+        """Run the prompt encoder and mask decoder on a precomputed image embedding.
+            Returns the three multimask outputs like SamPredictor.predict."""
+        features, original_size, input_size = embedding
+        # Prompt points in encoder input coordinates with the padding point of SamPredictor
+        coords = point_coords * np.array([input_size[1] / original_size[1], input_size[0] / original_size[0]])
+        coords = np.concatenate([coords, [[0.0, 0.0]]])[None].astype(np.float32)
+        labels = np.concatenate([point_labels, [-1]])[None].astype(np.float32)
+
+        scores, low_res = self.decoder.run(None, {
+            "image_embeddings": features,
+            "point_coords": coords,
+            "point_labels": labels,
+            "mask_input": np.zeros((1, 1, 4 * features.shape[2], 4 * features.shape[3]), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+        })
+        masks = postprocess(low_res[0, 1:], input_size, original_size)
+
+        return masks > MASK_THRESHOLD, scores[0, 1:], low_res[0, 1:]
+
+    def reset(self):
+        pass
+
+    def stats(self):
+        return {
+            "load_time_s": round(self.load_time, 3),
+            "resident_mb": round(self.nbytes / 2**20, 1),
+            "idle_s": round(time.monotonic() - self.last_used, 1),
+        }
+
+
+def mask_iou(a, b):
+    """Intersection over union of two binary masks, 1 if both are empty."""
+
+    union = np.count_nonzero(a | b)
+
+    return np.count_nonzero(a & b) / union if union else 1.0
@@ -0,0 +1,236 @@
+"""This module contains a process-wide registry of loaded Segment Anything
+Model (SAM) backbones, so checkpoints are read from disk only once.
+PyTorch, segment_anything and ONNX Runtime are imported when the first
+backbone is loaded, so CV-only processes never import them."""
+
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from .sam_onnx import OnnxSamEntry, export_onnx, onnx_paths, quantize_onnx
+
+logger = logging.getLogger(__name__)
+
+# Inference backends of the SAM stage
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def sam_backend(args):
+    """Backend name of the parsed arguments, --sam-quantize selects int8 ONNX models."""
+
+    if args.sam_backend == "onnx" and args.sam_quantize:
+        return "onnx-int8"
+
+    return args.sam_backend
+
+
+class SamEntry:
+    """A loaded SAM backbone with its predictor and load statistics.
+        The predictor keeps per-image state, hence callers hold `lock`
+        while running encode/decode."""
+
+    def __init__(self, name, model, load_time):
+        from segment_anything import SamPredictor
+
+        self.name = name
+        self.model = model
+        self.predictor = SamPredictor(model)
+        self.lock = threading.Lock()
+        self.load_time = load_time
+        self.nbytes = sum(t.numel() * t.element_size() for t in model.parameters()) + \
+                      sum(t.numel() * t.element_size() for t in model.buffers())
+        self.last_used = time.monotonic()
+
+    def encode(self, imgs):
+        """Run the image encoder on a batch of images in one forward pass.
+            Returns one embedding (features, original_size, input_size) per image."""
+        import torch
+
+        transform = self.predictor.transform
+        inputs, sizes = [], []
+        for img in imgs:
+            input_image = transform.apply_image(img)
+            input_image = torch.as_tensor(input_image, device=self.predictor.device).permute(2, 0, 1).contiguous()
+            inputs.append(self.model.preprocess(input_image[None])[0])
+            sizes.append((img.shape[:2], tuple(input_image.shape[-2:])))
+
+        with torch.no_grad():
+            features = self.model.image_encoder(torch.stack(inputs))
+
+        # Copies, a cached view of one image would keep the features of the whole batch alive
+        return [(features[i:i+1].clone(), original_size, input_size) for i, (original_size, input_size) in enumerate(sizes)]
+
+    def decode(self, embedding, point_coords, point_labels):
+        """Run the prompt encoder and mask decoder on a precomputed image embedding."""
+        self.predictor.features, self.predictor.original_size, self.predictor.input_size = embedding
+        self.predictor.is_image_set = True
+
+        return self.predictor.predict(point_coords=point_coords, point_labels=point_labels, multimask_output=True)
+
+    def reset(self):
+        self.predictor.reset_image()
+
+    def stats(self):
+        return {
+            "load_time_s": round(self.load_time, 3),
+            "resident_mb": round(self.nbytes / 2**20, 1),
+            "idle_s": round(time.monotonic() - self.last_used, 1),
+        }
+
+
+class SamRegistry:
+    """Load each SAM backbone (vit_b/vit_l/vit_h) once per backend and keep it resident.
+        If a memory budget (MB) is set, idle backbones are evicted in least
+        recently used order until the resident size fits the budget.
+        ONNX models are exported from the checkpoint on first use and reused
+        from `onnx_dir` afterwards."""
+
+    def __init__(self, ckpt_dir="model_ckpts", memory_budget=0, onnx_dir=None, threads=0, inter_threads=0):
+        self.ckpt_dir = ckpt_dir
+        self.memory_budget = memory_budget
+        self.onnx_dir = onnx_dir
+        self.threads = threads
+        self.inter_threads = inter_threads
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ckpt_dir=None, memory_budget=None, onnx_dir=None, threads=None, inter_threads=None):
+        """Update checkpoint directory, memory budget (MB, 0 is unlimited),
+            ONNX model directory and ONNX Runtime threads (0 is the default)."""
+        with self._lock:
+            if ckpt_dir is not None:
+                self.ckpt_dir = ckpt_dir
+            if memory_budget is not None:
+                self.memory_budget = memory_budget
+            if onnx_dir is not None:
+                self.onnx_dir = onnx_dir
+            if threads is not None:
+                self.threads = threads
+            if inter_threads is not None:
+                self.inter_threads = inter_threads
+            self._evict(keep=None)
+
+    def checkpoint(self, name):
+        return os.path.join(self.ckpt_dir, f"sam_{name}.pth")
+
+    def get(self, name, backend="torch"):
+        """Return the loaded entry of backbone `name` on `backend`, loading it on first use."""
+        key = name if backend == "torch" else f"{name}:{backend}"
+        with self._lock:
+            entry = self._entries.get(key)
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        if entry is None:
+            # Loading takes seconds, only requests for the same backbone wait for it
+            with loading:
+                with self._lock:
+                    entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._load(name) if backend == "torch" else self._load_onnx(name, backend)
+                    with self._lock:
+                        self._entries[key] = entry
+                        self._evict(keep=key)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            entry.last_used = time.monotonic()
+
+        return entry
+
+    def warmup(self, names, infer=True, backend="torch"):
+        """Load backbones and run one dummy inference so that the first
+            request does not pay for lazy initialization."""
+        for name in names:
+            entry = self.get(name, backend)
+            if not infer:
+                continue
+            with entry.lock:
+                embedding = entry.encode([np.zeros((64, 64, 3), dtype=np.uint8)])[0]
+                entry.decode(embedding, np.array([[32, 32]]), np.array([1]))
+                entry.reset()
+
+    def evict(self, name):
+        with self._lock:
+            return self._entries.pop(name, None) is not None
+
+    def resident_bytes(self):
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_budget_mb": self.memory_budget,
+                "resident_mb": round(self.resident_bytes() / 2**20, 1),
+                "models": {name: entry.stats() for name, entry in self._entries.items()},
+            }
+
+    def _load(self, name):
+        start = time.perf_counter()
+        entry = SamEntry(name, self._load_model(name), time.perf_counter() - start)
+        logger.info("Loaded SAM backbone %s in %.2fs (%.1f MB)", name, entry.load_time, entry.nbytes / 2**20)
+
+        return entry
+
+    def _load_model(self, name):
+        """Build the PyTorch model of backbone `name` from its checkpoint."""
+        try:
+            from segment_anything import sam_model_registry
+        except ImportError as e:
+            raise ImportError("The PyTorch SAM backend and the ONNX export require torch and "
+                              "segment_anything (requirements.txt)") from e
+
+        # Assert SAM backbones exist in checkpoint directory
+        assert name in sam_model_registry, f"Unknown SAM backbone {name}"
+        assert os.path.exists(self.checkpoint(name)), f"SAM checkpoint {self.checkpoint(name)} not found"
+
+        model = sam_model_registry[name](checkpoint=self.checkpoint(name))
+        model.eval()
+
+        return model
+
+    def _load_onnx(self, name, backend):
+        onnx_dir = self.onnx_dir or os.path.join(self.ckpt_dir, "onnx")
+        encoder_path, decoder_path = onnx_paths(onnx_dir, name)
+        quantized_paths = onnx_paths(onnx_dir, name, quantize=True)
+
+        start = time.perf_counter()
+        if not (os.path.exists(encoder_path) and os.path.exists(decoder_path)):
+            # Exporting requires PyTorch, exported models run without it
+            model = self._load_model(name)
+            export_onnx(model, encoder_path, decoder_path)
+            logger.info("Exported SAM backbone %s to ONNX in %.2fs", name, time.perf_counter() - start)
+            del model
+        if backend == "onnx-int8":
+            for src, dst in zip((encoder_path, decoder_path), quantized_paths):
+                if not os.path.exists(dst):
+                    quantize_onnx(src, dst)
+            encoder_path, decoder_path = quantized_paths
+
+        entry = OnnxSamEntry(name, encoder_path, decoder_path, self.threads, self.inter_threads)
+        entry.load_time = time.perf_counter() - start
+        logger.info("Loaded SAM backbone %s (%s) in %.2fs (%.1f MB)", name, backend, entry.load_time, entry.nbytes / 2**20)
+
+        return entry
+
+    def _evict(self, keep):
+        """Evict least recently used idle backbones exceeding the memory budget."""
+        if not self.memory_budget:
+            return
+        for name in list(self._entries):
+            if self.resident_bytes() <= self.memory_budget * 2**20:
+                break
+            entry = self._entries[name]
+            if name == keep or not entry.lock.acquire(blocking=False):
+                continue
+            entry.lock.release()
+            del self._entries[name]
+            logger.info("Evicted SAM backbone %s (%.1f MB)", name, entry.nbytes / 2**20)
+
+
+SAM_REGISTRY = SamRegistry()
@@ -1,16 +1,47 @@
 """This module contains methods used to segment the brick of interest."""
 
-import os
+from collections import namedtuple
+from functools import lru_cache
+
 import numpy as np
 import cv2
 
-from segment_anything import SamPredictor, sam_model_registry
+from .sam_registry import SAM_REGISTRY, sam_backend
+from .embedding_cache import EMBEDDING_CACHE, embedding_key
+
+
+CannyBank = namedtuple("CannyBank", ["blur_kernels", "thresholds", "voting_thresh"])
+
+
+def to_gray(img):
+    """Return the grayscale image of a BGR image, grayscale images are passed through.
+        Computing it once lets segment_canny and segment_thresh share it."""
+
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def canny_bank(args):
+    """Return the validated blur kernel and threshold bank of the canny voting."""
+
+    return _canny_bank(
+        tuple((tuple(kernel), sigma) for kernel, sigma in args.blur_kernel_canny),
+        tuple(tuple(thresh) for thresh in args.canny_thresh),
+        args.voting_thresh,
+    )
+
+
+@lru_cache(maxsize=None)
+def _canny_bank(blur_kernels, thresholds, voting_thresh):
+    # Assert voting threshold is smaller than number of masks
+    assert voting_thresh <= (len(blur_kernels) * len(thresholds))
+
+    return CannyBank(blur_kernels, thresholds, voting_thresh)
 
 
 def segment_thresh(img, args):
     """This method segments the brick of interest based on adaptive thresholding."""
     
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(img)
     blur = cv2.medianBlur(gray,args.blur_kernel_thresh)
 
     mask = cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, args.thresh_blocksize, args.thresh_c)
@@ -20,49 +51,123 @@ def segment_thresh(img, args):
 
 def segment_canny(img, args):
     """This method segments the brick of interest based on canny edges.
-        The edges are created based on a voting of multiple canny masks."""
+        The edges are created based on a voting of multiple canny masks.
+        The image gradients are computed once per blur kernel and shared by
+        all canny thresholds, votes are accumulated in uint8."""
 
-    # Assert voting threshold is smaller than number of masks
-    assert args.voting_thresh <= (len(args.blur_kernel_canny) * len(args.canny_thresh))
+    bank = canny_bank(args)
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    mask = np.zeros(gray.shape, dtype=np.float64)
+    gray = to_gray(img)
+    votes = np.zeros(gray.shape, dtype=np.uint8)
 
-    for blur_kernel in args.blur_kernel_canny:
-        blur = cv2.GaussianBlur(gray, blur_kernel[0], blur_kernel[1])
-        for canny_thresh in args.canny_thresh:
-            mask += cv2.Canny(blur, canny_thresh[0], canny_thresh[1]) / 255
-    
-    mask = mask > args.voting_thresh
-    mask.dtype = "uint8"
-    mask *= 255
+    for kernel, sigma in bank.blur_kernels:
+        blur = cv2.GaussianBlur(gray, kernel, sigma)
+        # Same 3x3 sobel gradients as cv2.Canny computes internally
+        dx = cv2.Sobel(blur, cv2.CV_16S, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE)
+        dy = cv2.Sobel(blur, cv2.CV_16S, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE)
+        for low, high in bank.thresholds:
+            cv2.add(votes, 1, dst=votes, mask=cv2.Canny(dx, dy, low, high))
+
+    _, mask = cv2.threshold(votes, bank.voting_thresh, 255, cv2.THRESH_BINARY)
 
     return mask
 
 
-def segment_sam(img, args):
-    """This method segments the brick of interest based on Meta's Segment
-        Anything Model (SAM)."""
+def segment_canny_single(img, args):
+    """This method segments the brick of interest based on a single canny mask
+        with the first blur kernel and threshold of the canny voting,
+        a fast alternative to segment_canny for well-lit scenes."""
 
-    # Assert SAM backbones exist in model_ckpts/
-    assert os.path.exists(f"model_ckpts/sam_{args.sam_model}.pth")
+    bank = canny_bank(args)
+    (kernel, sigma), (low, high) = bank.blur_kernels[0], bank.thresholds[0]
 
-    sam = sam_model_registry[args.sam_model](checkpoint=f"model_ckpts/sam_{args.sam_model}.pth")
-    predictor = SamPredictor(sam)
-    predictor.set_image(img)
+    return cv2.Canny(cv2.GaussianBlur(to_gray(img), kernel, sigma), low, high)
+
+
+def sam_predict_batch(imgs, args):
+    """Return the SAM masks and scores of the center point prompt of multiple ROIs,
+        run on the backend selected by args.sam_backend. Up to args.sam_batch_size
+        ROIs share one image encoder forward pass, each ROI is then decoded with
+        its own center point prompt. Embeddings of previously seen ROIs
+        are taken from the embedding cache and skip the image encoder."""
+
+    # Backbone is loaded once per process and backend and shared across requests
+    backend = sam_backend(args)
+    entry = SAM_REGISTRY.get(args.sam_model, backend)
+    predictions = []
+
+    for start in range(0, len(imgs), args.sam_batch_size):
+        batch = imgs[start:start + args.sam_batch_size]
+        keys = [embedding_key(img, f"{args.sam_model}:{backend}") for img in batch]
+        embeddings = [EMBEDDING_CACHE.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        with entry.lock:
+            if missing:
+                for i, embedding in zip(missing, entry.encode([batch[i] for i in missing])):
+                    embeddings[i] = embedding
+                    EMBEDDING_CACHE.put(keys[i], embedding)
+            for img, embedding in zip(batch, embeddings):
+                sam_masks, scores, _ = entry.decode(
+                    embedding,
+                    point_coords=np.array([[img.shape[1] // 2, img.shape[0] // 2]]),
+                    point_labels=np.array([1]),
+                    )
+                predictions.append((sam_masks, scores))
+
+    return predictions
+
+
+def segment_floodfill(img, args):
+    """This method segments the brick of interest as the region connected to the
+        center prompt whose color differs less than args.flood_tolerance from the
+        median color of the center patch, the cheapest mask segmentation."""
+
+    blur = cv2.medianBlur(img, 5)
+    h, w = blur.shape[:2]
+    cy, cx = h // 2, w // 2
+    patch = blur[cy - h // 20:cy + h // 20 + 1, cx - w // 20:cx + w // 20 + 1].reshape(-1, blur.shape[2] if blur.ndim == 3 else 1)
+    blur[cy, cx] = np.median(patch, axis=0).astype(np.uint8)
+
+    mask = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    tol = (args.flood_tolerance,) * 3
+    cv2.floodFill(blur, mask, (cx, cy), 0, tol, tol, 4 | cv2.FLOODFILL_FIXED_RANGE | cv2.FLOODFILL_MASK_ONLY | (255 << 8))
+
+    # Close holes of noisy pixels inside the brick face
+    return cv2.morphologyEx(mask[1:-1, 1:-1], cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+
+
+def segment_watershed(img, args):
+    """This method refines the floodfill segmentation of the brick of interest
+        with a marker based watershed: the eroded floodfill region and the center
+        patch are the brick marker, the ROI border and everything outside the
+        dilated region the background marker. The regions grow until they meet
+        at the strongest color edges in between, i.e. the brick outline."""
+
+    img = img if img.ndim == 3 else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    h, w = img.shape[:2]
+    flood = segment_floodfill(img, args)
+
+    markers = np.zeros((h, w), dtype=np.int32)
+    markers[cv2.dilate(flood, np.ones((11, 11), np.uint8)) == 0] = 1
+    # cv2.watershed ignores the outermost pixels, the border marker starts inside
+    markers[[1, -2]] = markers[:, [1, -2]] = 1
+    markers[cv2.erode(flood, np.ones((5, 5), np.uint8)) > 0] = 2
+    markers[h // 2 - h // 20:h // 2 + h // 20 + 1, w // 2 - w // 20:w // 2 + w // 20 + 1] = 2
+    cv2.watershed(img, markers)
+
+    return np.where(markers == 2, 255, 0).astype(np.uint8)
+
+
+def sam_mask(sam_masks, scores):
+    """Return the highest scoring SAM mask as binary uint8 mask."""
+
+    return (sam_masks[np.argmax(scores)] * 255).astype(np.uint8)
 
-    sam_masks, scores, _ = predictor.predict(
-        point_coords=np.array([[args.roi_winsize[0] // 2, args.roi_winsize[1] // 2]]),
-        point_labels=np.array([1]),
-        multimask_output=True,
-        )
-    
-    max_score_idx = np.argmax(scores)
-    sam_mask = sam_masks[max_score_idx] * 255
-    sam_mask = sam_mask.astype(np.uint8)
 
-    blur = cv2.blur(sam_mask, (10,10))
+def mask2edges(mask):
+    """Convert a binary brick mask to an edge mask."""
 
-    mask = cv2.Canny(blur, 50, 200, None, 3)
+    blur = cv2.blur(mask, (10,10))
 
-    return mask
\ No newline at end of file
+    return cv2.Canny(blur, 50, 200, None, 3)
@@ -0,0 +1,184 @@
+"""This module runs the pose estimation on frame sequences and tracks the brick
+from frame to frame instead of detecting it from scratch in every frame."""
+
+import os
+import time
+
+import numpy as np
+import cv2
+
+from .pose_estimation_cv import pose_estimation_cv
+from .pose_estimation_sam import pose_estimation_sam
+from .pose_estimation_plane import pose_estimation_plane
+from .batch import find_pairs, IMAGE_EXTENSIONS
+from .utils.utils import load_image, angle_from_lines, roi_window
+from .utils.profiling import NULL_PROFILER
+from .config import freeze
+from .validation import check, PoseValidationError
+
+POSE_KEYS = ["x", "y", "z", "roll", "pitch", "yaw"]
+
+
+def frame_source(source, depth=None):
+    """Iterate (color, depth) frames of a sequence. The source can be an iterable of
+    (color, depth) pairs, a capture directory or manifest (see batch.find_pairs)
+    in sorted order, or a color video file with `depth` a directory or manifest of
+    depth images (one per video frame)."""
+
+    if not isinstance(source, (str, os.PathLike)):
+        yield from source
+        return
+
+    if depth is None:
+        yield from find_pairs(source)
+        return
+
+    if os.path.isdir(depth):
+        depths = sorted(os.path.join(depth, name) for name in os.listdir(depth) if name.lower().endswith(IMAGE_EXTENSIONS))
+    else:
+        with open(depth) as f:
+            base = os.path.dirname(os.path.abspath(depth))
+            depths = [os.path.join(base, line.strip()) for line in f if line.strip() and not line.startswith("#")]
+
+    video = cv2.VideoCapture(os.fspath(source))
+    assert video.isOpened(), f"Video {source} could not be opened"
+    try:
+        for depth_frame in depths:
+            ok, color = video.read()
+            if not ok:
+                break
+            yield color, depth_frame
+    finally:
+        video.release()
+
+
+class PoseTracker:
+    """Estimate the brick pose of consecutive frames of one camera.
+
+    After a successful estimation the next frame is searched in a tracking window
+    centered at the brick of the previous frame (ROI height reduced to the brick
+    height plus args.track_margin) and Hough lines are only searched within
+    +-args.track_theta degrees of the previous line angle. If the tracked
+    estimation fails, the position jumps by more than args.track_gate mm, an
+    angle changes by more than args.track_angle_gate degrees or the brick is less
+    than half its expected height, tracking is lost and the frame is estimated
+    with the full ROI again.
+    Poses are smoothed with an exponential moving average (args.track_smoothing)."""
+
+    def __init__(self, args):
+        self.args = freeze(args, image_format="none")
+        if getattr(self.args, "sam", False):
+            self.estimate = pose_estimation_sam
+        elif getattr(self.args, "plane", False):
+            self.estimate = pose_estimation_plane
+        else:
+            self.estimate = pose_estimation_cv
+        self.reset()
+
+    def reset(self):
+        self.window = None
+        self.pose = None
+        self.corner_stone = None
+        self.height = None
+
+    def update(self, color, depth, profiler=NULL_PROFILER):
+        """Estimate the pose of the next frame. Returns the output of the pipeline
+        with the smoothed pose, the unsmoothed pose under "raw_pose" and whether
+        the frame was "tracked" or "detected". Raises AssertionError if the brick
+        is neither found by tracking nor by full detection."""
+
+        with profiler.stage("decode"):
+            color, depth = load_image(color), load_image(depth, cv2.IMREAD_UNCHANGED)
+        check(color is not None, "decode_error", "Color image could not be decoded")
+
+        output = None
+        if self.window is not None:
+            feats = {}
+            try:
+                output = self.estimate(color, depth, self.window, profiler, feats)
+                if self._lost(output["pose"], feats):
+                    output = None
+            except AssertionError:
+                output = None
+            profiler.count("track_lost" if output is None else "track_hits")
+
+        status = "tracked"
+        if output is None:
+            status = "detected"
+            self.reset()
+            feats = {}
+            output = self.estimate(color, depth, self.args, profiler, feats)
+
+        self.corner_stone = feats["corner_stone"]
+        self.height = self._height(output["pose"])
+        self.window = self._window(feats, color.shape)
+        output["raw_pose"] = output["pose"]
+        output["pose"] = self._smooth(output["pose"])
+        output["status"] = status
+
+        return output
+
+    def _lost(self, pose, feats):
+        """Whether a tracked estimation deviates from the previous frame."""
+
+        args, points = self.args, feats["points"]
+
+        return (np.linalg.norm([pose[k] - self.pose[k] for k in "xyz"]) > args.track_gate
+                or max(abs(pose[k] - self.pose[k]) for k in ["roll", "pitch", "yaw"]) > args.track_angle_gate
+                or feats["corner_stone"] != self.corner_stone
+                or points["bot"][1] - points["top"][1] < self.height / 2)
+
+    def _height(self, pose):
+        """Expected brick height (px) at the depth of the front face of the pose."""
+
+        args = self.args
+        face = pose["y"] - (args.brick_width if self.corner_stone else args.brick_depth) / 2
+
+        return args.fy * args.brick_height / face
+
+    def _smooth(self, pose):
+        pose = {k: float(pose[k]) for k in POSE_KEYS}
+        if self.pose is not None:
+            alpha = self.args.track_smoothing
+            pose = {k: round(alpha * pose[k] + (1 - alpha) * self.pose[k], 1) for k in POSE_KEYS}
+        self.pose = pose
+
+        return dict(pose)
+
+    def _window(self, feats, shape):
+        """Config of the tracking window around the detected brick."""
+
+        points, args = feats["points"], self.args
+        # The window fits at least the expected brick, a degenerate detection never shrinks it
+        brick = max(points["bot"][1] - points["top"][1], self.height)
+        height = min(brick + 2 * args.track_margin, args.roi_winsize[1])
+        pitch = angle_from_lines(feats["lines"])
+        window = roi_window(args, points["mid"], (args.roi_winsize[0], height), shape)
+
+        return window.replace(hough_theta_range=(pitch - args.track_theta, pitch + args.track_theta), adaptive_roi=False)
+
+
+def track(frames, args, profiler=NULL_PROFILER):
+    """Track the brick pose over a sequence of (color, depth) frames.
+    Yields one result record per frame, failed frames are recorded
+    instead of being raised."""
+
+    tracker = PoseTracker(args)
+    for i, (color, depth) in enumerate(frames):
+        record = {"frame": i}
+        start = time.perf_counter()
+        try:
+            output = tracker.update(color, depth, profiler)
+            record["status"] = output["status"]
+            record["pose"] = output["pose"]
+            record["raw_pose"] = {k: float(v) for k, v in output["raw_pose"].items()}
+        # On insufficient/invalid pose estimation record error message
+        except AssertionError as e:
+            tracker.reset()
+            record["status"] = "failed"
+            record["error"] = str(e) or "AssertionError"
+            if isinstance(e, PoseValidationError):
+                record["code"] = e.code
+        record["time_s"] = round(time.perf_counter() - start, 4)
+
+        yield record
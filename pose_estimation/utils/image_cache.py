@@ -0,0 +1,54 @@
+"""This module contains a short-lived cache of annotated result images, which
+clients fetch on demand instead of receiving them encoded in every response."""
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+    """Bounded cache of result images with expiry after `ttl` seconds.
+        The oldest image is dropped when `maxsize` images are cached."""
+
+    def __init__(self, maxsize=64, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, ttl):
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._expire()
+
+    def put(self, img):
+        """Cache an image and return its id."""
+        image_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[image_id] = (time.monotonic() + self.ttl, img)
+            self._expire()
+
+        return image_id
+
+    def get(self, image_id):
+        """Return the cached image or None if it is unknown or expired."""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(image_id)
+
+        return entry[1] if entry is not None else None
+
+    def stats(self):
+        with self._lock:
+            self._expire()
+            return {"size": len(self._entries), "maxsize": self.maxsize, "ttl_s": self.ttl}
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._entries and (len(self._entries) > self.maxsize or next(iter(self._entries.values()))[0] < now):
+            self._entries.popitem(last=False)
+
+
+IMAGE_CACHE = ImageCache()
@@ -0,0 +1,153 @@
+"""This module contains the stage-level instrumentation of the pose estimation pipelines."""
+
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+# Optional dependencies of the SAM path, imported on first use
+HEAVY_MODULES = ("torch", "segment_anything", "onnxruntime")
+
+# Upper bounds (ms) of the latency histogram buckets
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf"))
+
+
+class Profiler:
+    """Record wall time and optionally peak traced memory per pipeline stage
+        as well as counters. Repeated stages accumulate their time.
+        Memory is only traced while tracemalloc is running, it is process wide
+        and therefore only exact without concurrent requests."""
+
+    def __init__(self, memory=False):
+        self.memory = memory and tracemalloc.is_tracing()
+        self.stages = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        if self.memory:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"time_ms": 0.0})
+            stage["time_ms"] += (time.perf_counter() - start) * 1e3
+            if self.memory:
+                peak = (tracemalloc.get_traced_memory()[1] - base) / 2**10
+                stage["peak_kb"] = max(stage.get("peak_kb", 0.0), peak)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {
+            "total_ms": round((time.perf_counter() - self._start) * 1e3, 3),
+            "stages": {name: {k: round(v, 3) for k, v in stage.items()} for name, stage in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+
+class NullProfiler:
+    """Profiler interface without any recording, used when profiling is disabled."""
+
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Metrics:
+    """Aggregate profiler reports per mode into latency histograms and counter totals."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {}
+
+    def observe(self, mode, report, ok=True, code=None):
+        """Record a profiler report. Failures with an error code are counted per
+        code, their saved compute is estimated as the mean latency of successful
+        estimations minus the time spent until the rejection."""
+        with self._lock:
+            metrics = self._modes.setdefault(mode, {"requests": 0, "failures": 0, "histograms": {}, "counters": {},
+                                                    "ok_ms": 0.0, "rejects": {}, "saved_ms": 0.0})
+            metrics["requests"] += 1
+            metrics["failures"] += not ok
+            if ok:
+                metrics["ok_ms"] += report["total_ms"]
+            elif code is not None:
+                metrics["rejects"][code] = metrics["rejects"].get(code, 0) + 1
+                successes = metrics["requests"] - metrics["failures"]
+                if successes:
+                    metrics["saved_ms"] += max(metrics["ok_ms"] / successes - report["total_ms"], 0.0)
+            self._observe(metrics["histograms"], "total", report["total_ms"])
+            for name, stage in report["stages"].items():
+                self._observe(metrics["histograms"], name, stage["time_ms"])
+            for name, n in report["counters"].items():
+                metrics["counters"][name] = metrics["counters"].get(name, 0) + n
+
+    @staticmethod
+    def _observe(histograms, name, value):
+        histogram = histograms.setdefault(name, {"count": 0, "sum_ms": 0.0, "buckets": [0] * len(BUCKETS_MS)})
+        histogram["count"] += 1
+        histogram["sum_ms"] += value
+        histogram["buckets"][int(np.searchsorted(BUCKETS_MS, value))] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "buckets_ms": [str(b) for b in BUCKETS_MS],
+                "modes": {
+                    mode: {
+                        "requests": metrics["requests"],
+                        "failures": metrics["failures"],
+                        "rejects": dict(metrics["rejects"]),
+                        "saved_ms": round(metrics["saved_ms"], 3),
+                        "counters": dict(metrics["counters"]),
+                        "histograms": {
+                            name: {
+                                "count": h["count"],
+                                "mean_ms": round(h["sum_ms"] / h["count"], 3),
+                                "buckets": list(h["buckets"]),
+                            } for name, h in metrics["histograms"].items()
+                        },
+                    } for mode, metrics in self._modes.items()
+                },
+            }
+
+
+METRICS = Metrics()
+
+
+def startup_report(start):
+    """Time (s) since `start` (a time.perf_counter() value), resident and peak
+    memory (MB) of the process and which of the heavy dependencies are imported."""
+
+    report = {"startup_s": round(time.perf_counter() - start, 3)}
+    try:
+        with open("/proc/self/statm") as f:
+            report["rss_mb"] = round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        scale = 2**20 if sys.platform == "darwin" else 2**10
+        report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20, 1)
+    except ImportError:
+        pass
+    report["imported"] = {name: name in sys.modules for name in HEAVY_MODULES}
+
+    return report
@@ -1,56 +1,113 @@
 """This module contains helper methods for calculation operations."""
 
+import os
 import json
 import numpy as np
 import cv2
 import base64
+from functools import lru_cache
+
+from ..validation import check
+from .image_cache import IMAGE_CACHE
+
+def load_image(src, flags=cv2.IMREAD_COLOR):
+    """Return a decoded image from an ndarray, a raw byte buffer,
+    a file-like object (e.g. an upload stream) or a file path."""
+
+    if isinstance(src, np.ndarray):
+        return src
+    if hasattr(src, "read"):
+        src = src.read()
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        # cv2.imdecode raises on empty buffers, e.g. an empty upload
+        return cv2.imdecode(np.frombuffer(src, dtype=np.uint8), flags) if len(src) else None
+
+    return cv2.imread(os.fspath(src), flags)
 
 def roi(img, args):
     """Return the region of interest window
     based on roi_center (x, y) and roi_winsize(width, height)"""
 
-    return img[args.roi_center[1]-args.roi_winsize[1]//2:args.roi_center[1]+args.roi_winsize[1]//2,
-               args.roi_center[0]-args.roi_winsize[0]//2:args.roi_center[0]+args.roi_winsize[0]//2]
+    return img[roi_slices(tuple(args.roi_center), tuple(args.roi_winsize))]
+
+@lru_cache(maxsize=64)
+def roi_slices(center, winsize):
+    """Row and column slices of the ROI window, cached per camera ROI."""
+
+    return (slice(center[1]-winsize[1]//2, center[1]+winsize[1]//2),
+            slice(center[0]-winsize[0]//2, center[0]+winsize[0]//2))
+
+def roi_window(args, center, winsize, shape):
+    """Config with an even sized ROI window at center (x, y), shifted to lie
+    inside an image of the given shape."""
+
+    width, height = int(winsize[0]) // 2 * 2, int(winsize[1]) // 2 * 2
+    center = (int(np.clip(center[0], width // 2, shape[1] - width // 2)),
+              int(np.clip(center[1], height // 2, shape[0] - height // 2)))
+
+    return args.replace(roi_center=center, roi_winsize=(width, height))
 
 def distance(line1, line2):
     """Calculate the distance between the closest points of two lines."""
 
-    dists = []
-    for point1 in line1:
-        for point2 in line2:
-            dist = np.linalg.norm(np.array(point1) - np.array(point2))
-            dists.append(dist)
+    return line_distances(line1, [line2])[0]
 
-    return min(dists)
+def line_distances(line, lines):
+    """Calculate the distances between the closest end points of a line and
+    each line of an (n, 2, 2) array of lines."""
 
-def cluster_lines(lines, thresh=40.0):
-    """Clustering multiple lines (Non-Maximum-Suppression)."""
+    p = np.asarray(line, dtype=np.float64).reshape(1, 2, 1, 2)
+    q = np.asarray(lines, dtype=np.float64).reshape(-1, 1, 2, 2)
 
-    clusters = []
-    for line in lines:
-        # Find an existing cluster to add the line to, if any
-        added = False
-        for cluster in clusters:
-            if any(distance(line, existing_line) < thresh for existing_line in cluster):
-                cluster.append(line)
-                added = True
-                break
-        # If no existing cluster fits, create a new cluster
-        if not added:
-            clusters.append([line])
-
-    return clusters
+    return np.sqrt(((p - q) ** 2).sum(axis=-1)).reshape(-1, 4).min(axis=1)
+
+def cluster_lines(lines, thresh=40.0, chunksize=256):
+    """Clustering multiple lines (Non-Maximum-Suppression).
+
+    A line joins the first cluster containing a line whose closest end point is
+    closer than thresh, otherwise it opens a new cluster. With lines ordered
+    strongest first (as returned by cv2.HoughLines) the clusters are ordered by
+    and start with their strongest line. End point distances are computed with
+    broadcasting in chunks of rows, the remaining loop only assigns labels."""
+
+    n = len(lines)
+    points = np.asarray(lines, dtype=np.float64).reshape(n, 2, 2)
+    sqnorm = (points ** 2).sum(axis=-1)
+    labels = np.empty(n, dtype=int)
+    nclusters = 0
+
+    for start in range(0, n, chunksize):
+        stop = min(start + chunksize, n)
+        # Squared end point distances |p|^2 + |q|^2 - 2 p.q for all four end point pairings
+        sqdist = np.minimum.reduce([
+            sqnorm[start:stop, a, None] + sqnorm[None, :stop, b] - 2 * points[start:stop, a] @ points[:stop, b].T
+            for a in (0, 1) for b in (0, 1)
+        ])
+        close = sqdist < thresh ** 2
+
+        for i in range(start, stop):
+            neighbors = labels[:i][close[i - start, :i]]
+            if neighbors.size:
+                labels[i] = neighbors.min()
+            else:
+                labels[i] = nclusters
+                nclusters += 1
+
+    order = np.argsort(labels, kind="stable")
+    bounds = np.searchsorted(labels[order], np.arange(nclusters + 1))
+
+    return [[lines[j] for j in order[bounds[c]:bounds[c + 1]]] for c in range(nclusters)]
 
 def line_duplicator(line, top, bot, args):
     """Translate single Hough line to edge with missing Hough line based on detected edge point."""
 
     slope = (line[0][1][1] - line[0][0][1]) / (line[0][1][0] - line[0][0][0])
-    if line[0][0][1] - line[0][0][0] * slope > 50:  # If bottom line successfully derived, translate to top line
-        assert top > 0 , "No sufficient information for Hough line transformation"
+    if line[0][0][1] - line[0][0][0] * slope > args.roi_winsize[1]//2:  # If bottom line successfully derived, translate to top line
+        check(top > 0, "hough_failed", "No sufficient information for Hough line transformation")
         line.insert(0, ((args.roi_winsize[0]//2-1000, int(top-1000*slope)), (args.roi_winsize[0]//2+1000, int(top+1000*slope))))
     else:                                           # If top line successfully derived, translate to bottom line
+        check(bot > 0, "hough_failed", "No sufficient information for Hough line transformation")
         line.append(((args.roi_winsize[0]//2-1000, int(bot-1000*slope)), (args.roi_winsize[0]//2+1000, int(bot+1000*slope))))
-        assert bot > 0 , "No sufficient information for Hough line transformation"
 
     return line
 
@@ -86,6 +143,8 @@ def roi2glob(img_coord_roi, args):
     return img_coord_glob
 
 def draw_feats(img, coords, lines):
+    """Draw points and lines on a copy of the image, the input frame stays unchanged."""
+    img = img.copy()
     for _, v in coords.items():
         cv2.circle(img, v, radius=7, color=(255, 0, 0), thickness=-1)
 
@@ -94,25 +153,35 @@ def draw_feats(img, coords, lines):
     
     return img
 
-def base64_converter(img):
-    _, buffer = cv2.imencode('.png', img)
-    img_string = base64.b64encode(buffer).decode()
+# Encoded result image formats with their OpenCV quality parameter
+IMAGE_FORMATS = {"png": None, "jpeg": cv2.IMWRITE_JPEG_QUALITY, "webp": cv2.IMWRITE_WEBP_QUALITY}
+
+def encode_image(img, fmt="png", quality=90):
+    """Encode an image as png, jpeg or webp, quality (0-100) applies to jpeg and webp."""
+    param = IMAGE_FORMATS[fmt]
+    _, buffer = cv2.imencode('.' + fmt, img, [] if param is None else [param, int(quality)])
+
+    return buffer.tobytes()
+
+def base64_converter(img, fmt="png", quality=90):
+    img_string = base64.b64encode(encode_image(img, fmt, quality)).decode()
 
     return img_string
 
-def output_parser(cam_coord, roll, pitch, yaw, img, args):
-    "Parse pose into JSON format including corner stone transformation."
+def output_parser(cam_coord, roll, pitch, yaw, corner_stone, img, args):
+    """Parse pose into JSON format including corner stone transformation.
+    The result image is added according to args.image_format, img is None if it is "none"."""
 
     res = {"pose": {}}
     res["pose"]["x"] = np.round(cam_coord["mid"][0], 1)
     
-    if args.corner_stone:
+    if corner_stone:
         res["pose"]["y"] = np.round(cam_coord["mid"][1], 1) + args.brick_width/2
     else:
         res["pose"]["y"] = np.round(cam_coord["mid"][1], 1) + args.brick_depth/2
     res["pose"]["z"] = np.round(cam_coord["mid"][2], 1)
     
-    if args.corner_stone:
+    if corner_stone:
         res["pose"]["roll"] = np.round(pitch, 1)
         res["pose"]["pitch"] = np.round(roll, 1)
     else:
@@ -121,6 +190,11 @@ def output_parser(cam_coord, roll, pitch, yaw, img, args):
 
     res["pose"]["yaw"] = np.round(yaw, 1)
 
-    res["resulting_image"] = base64_converter(img)
+    # Result image encoded in the response, cached for /images/<image_id> or omitted
+    if args.image_format in IMAGE_FORMATS:
+        res["resulting_image"] = base64_converter(img, args.image_format, args.image_quality)
+        res["image_format"] = args.image_format
+    elif args.image_format == "lazy":
+        res["image_id"] = IMAGE_CACHE.put(img)
 
     return res
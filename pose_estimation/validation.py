@@ -0,0 +1,67 @@
+"""This module contains the validation of intermediate pipeline results. Invalid
+frames are rejected with typed error codes, cheap checks run before the expensive
+stages so rejected frames cost as little compute as possible."""
+
+import numpy as np
+
+# Error codes of rejected estimations and the stage they are raised in
+ERROR_CODES = {
+    "decode_error": "decode",
+    "shape_mismatch": "decode",
+    "no_valid_depth": "localize",
+    "no_brick": "localize",
+    "depth_coverage": "roi",
+    "edge_count": "segmentation",
+    "vertical_edges": "edges",
+    "horizontal_edges": "edges",
+    "hough_failed": "hough",
+    "plane_fit": "plane",
+    "invalid_depth": "projection",
+    "invalid_coordinates": "projection",
+    "invalid_angles": "angles",
+}
+
+
+class PoseValidationError(AssertionError):
+    """Rejected pose estimation with an error code of ERROR_CODES. Subclasses
+        AssertionError, so callers catching failed estimations keep working."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.stage = ERROR_CODES[code]
+
+    def to_dict(self):
+        return {"error": str(self), "code": self.code, "stage": self.stage}
+
+
+def check(condition, code, message):
+    """Raise a PoseValidationError with code and message if condition is false."""
+
+    if not condition:
+        raise PoseValidationError(code, message)
+
+
+def check_depth_coverage(depth_roi, args):
+    """Reject ROIs with less than args.min_depth_coverage valid depth pixels."""
+
+    coverage = np.count_nonzero(depth_roi) / depth_roi.size
+    check(coverage >= args.min_depth_coverage, "depth_coverage",
+          f"Insufficient depth coverage in ROI ({coverage:.0%})")
+
+
+def check_edge_count(mask, args):
+    """Reject edge masks with an edge pixel ratio outside args.edge_ratio,
+    i.e. ROIs without structure or with too much clutter for the Hough transformation."""
+
+    ratio = np.count_nonzero(mask) / mask.size
+    check(args.edge_ratio[0] <= ratio <= args.edge_ratio[1], "edge_count",
+          f"Edge pixel ratio {ratio:.1%} out of range")
+
+
+
+def check_angles(roll, pitch, yaw):
+    """Reject non-finite angles, e.g. of degenerate feature points, before the output."""
+
+    check(np.isfinite([roll, pitch, yaw]).all(), "invalid_angles",
+          f"Pose uncertain: invalid angles (roll {roll}, pitch {pitch}, yaw {yaw})")